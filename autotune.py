@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import platform
+import numpy as np
+
+
+# tuning database (measured costs per machine)
+TUNING_FILE = os.path.join(os.path.dirname(__file__), 'tuning.json')
+
+# candidate block sizes (N, the FFT point is 2N)
+N_MIN = 2 ** 7
+N_MAX = 2 ** 19
+
+# upper limit of the FIR spectra (bytes)
+MEM_LIMIT = 2 * 1024 ** 3
+
+# upper limit of the arrays used by a measurement (bytes)
+MEM_BENCH = 64 * 1024 ** 2
+
+
+
+class Tuner:
+    # Block size selection for export
+    #
+    # The render time of a task is modeled as
+    #
+    #   FIR transform:  P * ch_out * ch_in * rfft(2N)
+    #   each block:     ch_in * rfft(2N) + ch_out * irfft(2N) + P * MAC(N)
+    #   blocks:         ceil((len_src + len_fir - 1) / N)
+    #
+    # where P = ceil(len_fir / N). The cost of rfft/irfft/MAC for each
+    # N is measured on this machine with the FFT backend in use, and
+    # saved in the tuning database, so that each one is measured once.
+
+    def __init__(self, fname=TUNING_FILE):
+        self.fname = fname
+        self.db = {}
+        try:
+            with open(fname) as f:
+                self.db = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def best_chunksize(self, fir_shape, ch_src, len_src, dtype, fft):
+        # return N that minimizes the render time
+        len_fir = fir_shape[-1]
+        if len(fir_shape) == 1:
+            ch_in = ch_out = ch_src
+        else:
+            ch_out, ch_in = fir_shape[0], fir_shape[1]
+        itemsize = np.dtype(np.result_type(dtype, np.complex64)).itemsize
+
+        table = self._table(fft)
+        best = None
+        N = N_MIN
+        while N <= N_MAX:
+            P = int(np.ceil(len_fir / N))
+            mem = P * (N + 1) * itemsize
+            if len(fir_shape) == 3:
+                mem *= ch_out * ch_in
+            if mem > MEM_LIMIT and best is not None:
+                break
+
+            cost = self.cost(table, fir_shape, ch_src, len_src, N, dtype, fft)
+            if best is None or cost < best[0]:
+                best = (cost, N)
+
+            # no more partitions to merge
+            if N >= len_fir + len_src:
+                break
+            N *= 2
+
+        self._save()
+        return best[1]
+
+    def cost(self, table, fir_shape, ch_src, len_src, N, dtype, fft):
+        # modeled render time (seconds)
+        len_fir = fir_shape[-1]
+        P = int(np.ceil(len_fir / N))
+        n_block = int(np.ceil((len_src + len_fir - 1) / N))
+        dt = np.dtype(dtype).name
+
+        t_rfft = self._lookup(table, 'rfft/%d/%s' % (N, dt),
+                                        self._measure_rfft, N, dtype, fft)
+        t_irfft = self._lookup(table, 'irfft/%d/%s' % (N, dt),
+                                        self._measure_irfft, N, dtype, fft)
+        if len(fir_shape) == 1:
+            ch_in = ch_out = ch_src
+            t_mac = self._lookup(table, 'mac/SISO/%d/%d/%s' % (N, ch_in, dt),
+                                    self._measure_mac_siso, N, ch_in, dtype)
+            t_build = P * t_rfft
+        else:
+            ch_out, ch_in = fir_shape[0], fir_shape[1]
+            t_mac = self._lookup(table, 'mac/MIMO/%d/%d/%s' % (N, ch_in, dt),
+                                    self._measure_mac_mimo, N, ch_in, dtype)
+            t_mac *= ch_out
+            t_build = P * ch_out * ch_in * t_rfft
+
+        t_block = ch_in * t_rfft + ch_out * t_irfft + P * t_mac
+        return t_build + n_block * t_block
+
+    def _table(self, fft):
+        # measured costs of this machine and FFT backend
+        machine = '%s/%s/%d/%r' % (platform.node(), platform.machine(),
+                                                    os.cpu_count() or 1, fft)
+        return self.db.setdefault(machine, {})
+
+    def _lookup(self, table, key, measure, *args):
+        if key not in table:
+            table[key] = measure(*args)
+        return table[key]
+
+    def _save(self):
+        tmp = '%s.%d.tmp' % (self.fname, os.getpid()) # (parallel export)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.db, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.fname)
+        except OSError:
+            pass
+
+    # ----- measurements (seconds) -----
+
+    def _measure_rfft(self, N, dtype, fft):
+        # rfft of a 2N-point channel
+        rows = self._rows(2 * N * np.dtype(dtype).itemsize, 16)
+        x = np.zeros([rows, 2 * N], dtype=dtype)
+        return _time(lambda: fft.rfft(x)) / rows
+
+    def _measure_irfft(self, N, dtype, fft):
+        # irfft of a 2N-point channel
+        cdtype = np.result_type(dtype, np.complex64)
+        rows = self._rows((N + 1) * np.dtype(cdtype).itemsize, 16)
+        x_f = np.zeros([rows, N + 1], dtype=cdtype)
+        return _time(lambda: fft.irfft(x_f, 2 * N)) / rows
+
+    def _measure_mac_siso(self, N, channel, dtype):
+        # MAC of a partition (see OverlapSave)
+        cdtype = np.result_type(dtype, np.complex64)
+        size = (N + 1) * (channel + 1) * np.dtype(cdtype).itemsize
+        P = self._rows(size, 16)
+        fir_f = np.zeros([N + 1, 1, P], dtype=cdtype)
+        x_f = np.zeros([N + 1, P, channel], dtype=cdtype)
+        out_f = np.zeros([N + 1, 1, channel], dtype=cdtype)
+        return _time(lambda: np.matmul(fir_f, x_f, out=out_f)) / P
+
+    def _measure_mac_mimo(self, N, ch_in, dtype):
+        # MAC of a partition for an output channel (see OverlapSaveMIMO)
+        cdtype = np.result_type(dtype, np.complex64)
+        size = (N + 1) * ch_in * np.dtype(cdtype).itemsize
+        rows = self._rows(size, 16)
+        fir_f = np.zeros([N + 1, rows, ch_in], dtype=cdtype)
+        x_f = np.zeros([N + 1, ch_in, 1], dtype=cdtype)
+        out_f = np.zeros([N + 1, rows, 1], dtype=cdtype)
+        return _time(lambda: np.matmul(fir_f, x_f, out=out_f)) / rows
+
+    def _rows(self, size, n_max):
+        # the number of rows of `size` bytes measured at once
+        return int(np.clip(MEM_BENCH // size, 1, n_max))
+
+
+
+def _time(func, repeat=5):
+    # best time of repeated calls
+    func()
+    best = np.inf
+    for i in range(repeat):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+
+# shared by batch export
+tuner = Tuner()
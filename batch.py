@@ -1,109 +1,178 @@
 import os
 import sys
 import time
-import wave
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
 import numpy as np
 
-from convolution import OverlapSave, OverlapSaveMIMO
+from convolution import OverlapSave, OverlapSaveMIMO, OverlapAdd
+from convolution import overlap_add_block, overlap_add_mem
+from convolution import trim_length, tail_l1
 import player
+import wavfile
+import pcm
+import fircache
+import fftbackend
+import autotune
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 
 
+# memory for the offline engine (OverlapAdd) of FFT point 'auto' (bytes)
+# The whole source is convolved with a single FFT if it fits,
+# otherwise large blocks, otherwise the partitioned convolver.
+OFFLINE_MEM = 1024 ** 3
+
+
+# parallel export (see _export_parallel())
+# WORKERS: the number of worker processes (1: serial, 0: all cores)
+# EXPORT_MEM: the memory of the tasks rendered at the same time (bytes)
+#             (None: half of the physical memory)
+WORKERS = 1
+EXPORT_MEM = None
+
+# resolution of the progress bar for each job of parallel export
+PROGRESS_STEPS = 1000
+
+# the smallest segment of a task rendered in parallel, relative to the
+# blocks to warm up the convolver (see _segments())
+SEGMENT_RATIO = 4
+
+# container of the output files: 'wav' (RF64 if larger than 4 GB), 'w64'
+CONTAINER = 'wav'
+
+# threads of FFT and MIMO convolution in an export process (-1: all cores)
+# Parallel export divides the cores among the workers.
+THREADS = -1
 
 
 # 大容量の書き出しの時の判断。
 
-def export(tasks, path, sampwidth, N_str, qprog):
+def export(tasks, path, sampwidth, N_str, qprog, dtype=np.float64,
+                            trim_db=None, workers=None, is_float=False):
+    # is_float: IEEE float output (sampwidth 4) instead of PCM
+    # (passed to the functions below as wavfmt = (sampwidth, is_float))
     
     if path[-1] != os.sep:
         path += os.sep
 
-    error_log = ''
+    if workers is None:
+        workers = WORKERS
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        return _export_parallel(tasks, path, (sampwidth, is_float), N_str,
+                                            qprog, dtype, trim_db, workers)
 
-    
-    num_tasks = len(tasks)
-    for cnt_task, task in enumerate(tasks):
+    error_log = ''
 
-        print('batch [%d/%d]' % (cnt_task + 1, num_tasks))
+    # FIR spectra shared by the tasks of this run
+    pool = fircache.SpectrumPool()
+    for unit in _units(tasks, N_str, dtype):
+        print('batch [%d/%d]' % (unit[0] + 1, len(tasks)))
         
         if qprog.wasCanceled():
             break
-        
-        # check
-        if task['path2src'] == '':
-            error_log += '[%d/%d] skipped\n' % (cnt_task + 1, num_tasks)
-            error_log += 'Reason: No source.\n'
-            task['playmark'] = '!'
-            continue
-        
-        elif task['gain_src'] == 0:
-            error_log += '[%d/%d] skipped\n' % (cnt_task + 1, num_tasks)
-            error_log += 'Reason: Source is muted.\n'
-            task['playmark'] = '!'
-            continue
-        
-        elif task['gain_fir'] == 0:
-            error_log += '[%d/%d] skipped\n' % (cnt_task + 1, num_tasks)
-            error_log += 'Reason: FIR is muted.\n'
-            task['playmark'] = '!'
-            continue
 
-        # make generator
-        try:
-            if task['path2fir'] == '':
-                gene = WavGenerator(task)
-            else:
-                gene = ConvGenerator(task, N_str)
-        except Exception as e:
-            error_log += '[%d/%d] failed\n' % (cnt_task + 1, num_tasks)
-            error_log += 'Reason: %s\n' % e
-            task['playmark'] = '!'
+        error_log += _export_unit(tasks, unit, path, (sampwidth, is_float),
+                                        N_str, qprog, dtype, trim_db, pool)
+
+    return error_log
+
+
+
+def _units(tasks, N_str, dtype):
+    # yield the indices of tasks exported at once
+    # ([i], or the tasks of the same source with FFT point 'auto',
+    # see GroupGenerator)
+    done = set() # tasks exported in a group
+    for cnt_task, task in enumerate(tasks):
+        if cnt_task in done:
             continue
-        
-        if qprog.wasCanceled():
-            break
+        if (N_str == 'auto' and task['path2src'] != ''
+                and task['path2fir'] != '' and task['gain_src'] != 0
+                and task['gain_fir'] != 0):
+            group = _group(tasks, cnt_task, done, dtype)
+            done.update(group)
+            yield group
+        else:
+            yield [cnt_task]
 
-        # process
-        src_base = os.path.splitext(os.path.basename(task['disp_src']))[0]
-        fir_base = os.path.splitext(os.path.basename(task['disp_fir']))[0]
-        
-        fname = '%s_%.1fdB' % (src_base, task['gain_src_db'])
-        if fir_base:
-            fname += '_%s_%.1fdB' % (fir_base, task['gain_fir_db'])
-        fname += '.wav'
-        
-        label = '\nExport [%d/%d]\n' % (cnt_task + 1, num_tasks)
-        label += 'Source: %s\n' % task['disp_src']
-        label += 'Channels: %d\n' % gene.nchannels_src
-        label += 'FIR: %s\n' % task['disp_fir']
-        label += 'Shape: %s\n' % gene.fir_shape
-        label += 'FFTpoint: %s\n' % gene.fftpoint
-        label += '--> %s' % fname
-        qprog.setLabelText(label)
-
-        qlabel = QtWidgets.QLabel(label)
-        qlabel.setAlignment(QtCore.Qt.AlignLeft)
-        qprog.setLabel(qlabel)
-        print(label)
-        
-        # ----- Classificate from here
-        if sampwidth == 2:
-            float2buffer = float2buffer_16bit
-        elif sampwidth == 3:
-            float2buffer = float2buffer_24bit
-        elif sampwidth == 4:
-            float2buffer = float2buffer_32bit
+
+def _export_unit(tasks, unit, path, wavfmt, N_str, qprog, dtype, trim_db,
+                                                                    pool):
+    # export tasks[unit] (see _units()), and return error log
+    if len(unit) > 1:
+        return _export_group(tasks, unit, path, wavfmt, qprog, dtype,
+                                                            trim_db, pool)
+    return _export_task(tasks, unit[0], path, wavfmt, N_str, qprog, dtype,
+                                                            trim_db, pool)
+
+
+def _export_task(tasks, cnt_task, path, wavfmt, N_str, qprog, dtype,
+                                                            trim_db, pool):
+    # export tasks[cnt_task], and return error log
+    error_log = ''
+    num_tasks = len(tasks)
+    task = tasks[cnt_task]
+    sampwidth, is_float = wavfmt
+    
+    # check
+    if task['path2src'] == '':
+        error_log += '[%d/%d] skipped\n' % (cnt_task + 1, num_tasks)
+        error_log += 'Reason: No source.\n'
+        task['playmark'] = '!'
+        return error_log
+    
+    elif task['gain_src'] == 0:
+        error_log += '[%d/%d] skipped\n' % (cnt_task + 1, num_tasks)
+        error_log += 'Reason: Source is muted.\n'
+        task['playmark'] = '!'
+        return error_log
+    
+    elif task['gain_fir'] == 0:
+        error_log += '[%d/%d] skipped\n' % (cnt_task + 1, num_tasks)
+        error_log += 'Reason: FIR is muted.\n'
+        task['playmark'] = '!'
+        return error_log
+
+    # make generator
+    try:
+        if task['path2fir'] == '':
+            gene = WavGenerator(task, dtype)
         else:
-            raise Exception ('Unsupported wave format')
+            # stop convolution when the rest is below 1 LSB
+            # (float has no LSB, and is not stopped)
+            lsb = 0 if is_float else 2.0 ** (1 - 8 * sampwidth)
+            gene = ConvGenerator(task, N_str, dtype, trim_db, lsb, pool)
+    except Exception as e:
+        error_log += '[%d/%d] failed\n' % (cnt_task + 1, num_tasks)
+        error_log += 'Reason: %s\n' % e
+        task['playmark'] = '!'
+        return error_log
+    
+    if qprog.wasCanceled():
+        return error_log
 
+    # process
+    fname = _fname(task)
+    
+    label = '\nExport [%d/%d]\n' % (cnt_task + 1, num_tasks)
+    label += 'Source: %s\n' % task['disp_src']
+    label += 'Channels: %d\n' % gene.nchannels_src
+    label += 'FIR: %s\n' % task['disp_fir']
+    label += 'Shape: %s\n' % gene.fir_shape
+    label += 'FFTpoint: %s\n' % gene.fftpoint
+    label += '--> %s' % fname
+    _set_label(qprog, label)
+    
+    # ----- Classificate from here
+    float2buffer = _float2buffer(wavfmt)
 
-        wav_params = (gene.nchannels_out, sampwidth, gene.fs,
-                                        0, 'NONE', 'not compressed')
-        
-        try:
-            ww =  wave.open(path + fname, 'wb')
-            ww.setparams(wav_params)
+    try:
+        with wavfile.WavWriter(path + fname, gene.nchannels_out, sampwidth,
+                gene.fs, gene.nframes_out, CONTAINER, is_float) as ww:
             task['peak'] = 0
             task['peak_db'] = -np.inf
             qprog.setRange(0, gene.n_loop)
@@ -114,66 +183,561 @@ def export(tasks, path, sampwidth, N_str, qprog):
                 data = gene.calc()
                 frames = float2buffer(data)
                 ww.writeframes(frames)
-            ww.close()
 
-        except Exception as e:
-            error_log += '[%d/%d] failed\n' % (cnt_task + 1, num_tasks)
-            error_log += 'Reason: %s\n' % e
-            task['playmark'] = '!'
-            continue
-        # ----- (Classificate) to here
+    except Exception as e:
+        error_log += '[%d/%d] failed\n' % (cnt_task + 1, num_tasks)
+        error_log += 'Reason: %s\n' % e
+        task['playmark'] = '!'
+        return error_log
+    # ----- (Classificate) to here
 
-        # peak warning
-        if task['peak_db'] > 0:
-            error_log += '[%d/%d] warning\n' % (cnt_task + 1, num_tasks)
-            error_log += 'Reason: %.1f dB over.\n' % (task['peak_db'])
+    # peak warning
+    if task['peak_db'] > 0:
+        error_log += '[%d/%d] warning\n' % (cnt_task + 1, num_tasks)
+        error_log += 'Reason: %.1f dB over.\n' % (task['peak_db'])
 
     return error_log
 
 
+def _set_label(qprog, label):
+    print(label)
+    if isinstance(qprog, _WorkerProgress):
+        return
+    qprog.setLabelText(label)
+    qlabel = QtWidgets.QLabel(label)
+    qlabel.setAlignment(QtCore.Qt.AlignLeft)
+    qprog.setLabel(qlabel)
+
+
+
+def _export_parallel(tasks, path, wavfmt, N_str, qprog, dtype, trim_db,
+                                                                    workers):
+    # export with a pool of worker processes
+    #
+    # The units of tasks (see _units()) are split into jobs: a unit
+    # (see _export_worker()), or a segment of a long task when there are
+    # fewer units than workers (see _segments() and _export_segment()).
+    # The jobs are started in order as long as the estimated memory of
+    # the running ones (see _unit_mem()) is within EXPORT_MEM (at least
+    # one runs). Each worker reports the progress of its job in shared
+    # memory, and stops at the next block when canceled. The peaks and
+    # playmarks of the tasks are copied back, and the error logs are
+    # joined in the order of the tasks.
+    units = list(_units(tasks, N_str, dtype))
+    mems = [_unit_mem(tasks, unit, N_str, dtype) for unit in units]
+    mem_limit = _export_mem()
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    n_split = -(-workers // max(len(units), 1))
+
+    logs = [''] * len(units)
+    jobs = [] # (index of unit, segment or None)
+    for k, unit in enumerate(units):
+        segments = None
+        if n_split > 1 and len(unit) == 1:
+            segments = _segments(tasks[unit[0]], N_str, dtype, trim_db,
+                                                        wavfmt, n_split)
+        if segments is None:
+            jobs.append((k, None))
+            continue
+        try:
+            offset = _create_wav(path + _fname(tasks[unit[0]]), wavfmt,
+                                                        *segments['wav'])
+        except Exception as e:
+            logs[k] = _unit_failed(tasks, unit, e)
+            continue
+        jobs += [(k, segment + (offset,)) for segment in segments['blocks']]
+
+    # ('spawn': forking a process with Qt is unsafe)
+    ctx = multiprocessing.get_context('spawn')
+    progress = ctx.Array('d', len(jobs), lock=False)
+    canceled = ctx.Event()
+    initargs = (progress, canceled, fircache.POOL_SIZE // workers,
+                                                        _settings(threads))
+    executor = concurrent.futures.ProcessPoolExecutor(workers, ctx,
+                                                    _init_worker, initargs)
+
+    n_jobs = {} # the number of unfinished jobs of a segmented unit
+    peaks = {} # the peak of a segmented unit (or the exception)
+    for k, segment in jobs:
+        if segment is not None:
+            n_jobs[k] = n_jobs.get(k, 0) + 1
+            peaks[k] = 0
+
+    running = {} # future: index of job
+    n_next = 0
+    n_done = 0
+    qprog.setRange(0, len(jobs) * PROGRESS_STEPS)
+    try:
+        while n_next < len(jobs) or running:
+            # start jobs within the limits
+            while (n_next < len(jobs) and not canceled.is_set()
+                    and len(running) < workers
+                    and (not running or sum(mems[jobs[j][0]] for j in
+                    running.values()) + mems[jobs[n_next][0]] <= mem_limit)):
+                k, segment = jobs[n_next]
+                try:
+                    if segment is None:
+                        future = executor.submit(_export_worker, tasks,
+                            n_next, units[k], path, wavfmt, N_str, dtype,
+                            trim_db)
+                    else:
+                        future = executor.submit(_export_segment, tasks,
+                            n_next, units[k][0], segment, path, wavfmt,
+                            dtype, trim_db)
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    # a worker has died, and no more jobs can be started
+                    # (the running ones fail with the same error)
+                    for k, segment in jobs[n_next:]:
+                        if segment is None:
+                            logs[k] = _unit_failed(tasks, units[k], e)
+                            n_done += 1
+                            continue
+                        peaks[k] = e
+                        n_jobs[k] -= 1
+                        if n_jobs[k] == 0:
+                            logs[k] = _segments_done(tasks, units[k][0], e)
+                            n_done += 1
+                    n_next = len(jobs)
+                    break
+                running[future] = n_next
+                n_next += 1
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, timeout=0.1,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                j = running.pop(future)
+                k, segment = jobs[j]
+                progress[j] = 1
+                if segment is None:
+                    try:
+                        logs[k], states = future.result()
+                    except Exception as e:
+                        logs[k], states = _unit_failed(tasks, units[k], e), {}
+                    for i, state in states.items():
+                        tasks[i].update(state)
+                    n_done += 1
+                    continue
+
+                # segment
+                try:
+                    if not isinstance(peaks[k], Exception):
+                        peaks[k] = max(peaks[k], future.result())
+                except Exception as e:
+                    peaks[k] = e
+                n_jobs[k] -= 1
+                if n_jobs[k] == 0:
+                    logs[k] = _segments_done(tasks, units[k][0], peaks[k])
+                    n_done += 1
+
+            if qprog.wasCanceled():
+                canceled.set()
+            label = '\nExport [%d/%d] (%d workers)\n' % (n_done,
+                                                        len(units), workers)
+            label += '\n'.join(sorted({'--> %s' % ', '.join(_fname(tasks[i])
+                    for i in units[jobs[j][0]]) for j in running.values()}))
+            qprog.setLabelText(label)
+            qprog.setValue(min(int(sum(progress) * PROGRESS_STEPS),
+                                        len(jobs) * PROGRESS_STEPS - 1))
+    finally:
+        canceled.set()
+        executor.shutdown()
+
+    return ''.join(logs)
+
+
+def _export_worker(tasks, j, unit, path, wavfmt, N_str, dtype, trim_db):
+    # export tasks[unit] in a worker process (job j), and return the error
+    # log and the states of the tasks ({index: {'peak': .., 'peak_db': ..,
+    # 'playmark': ..}})
+    qprog = _WorkerProgress(j)
+    if qprog.wasCanceled():
+        return '', {}
+    error_log = _export_unit(tasks, unit, path, wavfmt, N_str, qprog,
+                                        dtype, trim_db, _worker['pool'])
+    keys = ('peak', 'peak_db', 'playmark')
+    states = {i: {key: tasks[i][key] for key in keys if key in tasks[i]}
+                                                                for i in unit}
+    return error_log, states
+
+
+def _segments(task, N_str, dtype, trim_db, wavfmt, n_max):
+    # split task into up to n_max segments (None: not split)
+    #
+    # return {'blocks': [(engine, n_0, n_1)], 'wav': (channels, fs, frames)}
+    # (engine: (engine, block size) of _engine(), so that the workers
+    # render with the blocks split here)
+    # The segments are the ranges of the blocks of ConvGenerator, and
+    # start within the source. Each one is at least SEGMENT_RATIO times
+    # longer than its warm-up (see ConvGenerator.seek_block()).
+    # The single FFT is not split.
+    # The output is the same as the serial export with integer output
+    # (float output may differ in the last bits, since the FFT plans of
+    # each process may differ).
+    if (task['path2src'] == '' or task['path2fir'] == ''
+            or task['gain_src'] == 0 or task['gain_fir'] == 0):
+        return None
+    try:
+        with wavfile.WavReader(task['path2src']) as wf:
+            nchannels, fs = wf.getnchannels(), wf.getframerate()
+            nframes = wf.getnframes()
+        fir = np.load(task['path2fir'], 'r')
+        if trim_db is not None:
+            fir = fir[..., :trim_length(fir, trim_db)]
+        if (fir.ndim not in (1, 3)
+                or fir.ndim == 3 and fir.shape[1] != nchannels):
+            return None # fails in _export_task()
+        engine, chunksize = _engine(fir.shape, nchannels, nframes, N_str,
+                                    dtype, fftbackend.get(workers=THREADS))
+    except Exception:
+        return None
+    if engine == 'single':
+        return None
+
+    len_out = nframes + fir.shape[-1] - 1
+    n_loop = int(np.ceil(len_out / chunksize))
+    n_src = nframes // chunksize
+    w = _warmup(engine, chunksize, fir.shape[-1])
+    n_seg = min(n_max, n_src // (SEGMENT_RATIO * w))
+    if n_seg < 2:
+        return None
+    bounds = [n_src * i // n_seg for i in range(n_seg)] + [n_loop]
+    ch_out = nchannels if fir.ndim == 1 else fir.shape[0]
+    return {'blocks': [((engine, chunksize), bounds[i], bounds[i + 1])
+                                                    for i in range(n_seg)],
+            'wav': (ch_out, fs, len_out)}
+
+
+def _export_segment(tasks, j, i, segment, path, wavfmt, dtype, trim_db):
+    # render the blocks [n_0, n_1) of tasks[i] in a worker process (job j)
+    # into its output file (see _create_wav()), and return the peak
+    # (offset: the data of the file)
+    engine, n_0, n_1, offset = segment
+    qprog = _WorkerProgress(j)
+    if qprog.wasCanceled():
+        return 0
+    task = tasks[i]
+    task['peak'] = 0
+    gene = ConvGenerator(task, None, dtype, trim_db, 0, _worker['pool'],
+                                                                    engine)
+    gene.seek_block(n_0)
+
+    float2buffer = _float2buffer(wavfmt)
+    bytes_per_frame = gene.nchannels_out * wavfmt[0]
+    with open(path + _fname(task), 'r+b') as f:
+        f.seek(offset + n_0 * gene.chunksize * bytes_per_frame)
+        qprog.setRange(0, n_1 - n_0)
+        for n in range(n_0, n_1):
+            if qprog.wasCanceled():
+                break
+            qprog.setValue(n - n_0)
+            f.write(float2buffer(gene.calc()))
+    return task['peak']
+
+
+def _segments_done(tasks, i, peak):
+    # error log of tasks[i] rendered in segments (see _export_segment())
+    # peak: the peak of all segments (or the exception of a segment)
+    if isinstance(peak, Exception):
+        return _unit_failed(tasks, [i], peak)
+    task = tasks[i]
+    task['peak'] = peak
+    task['peak_db'] = 20 * np.log10(peak) if peak > 0 else -np.inf
+    if task['peak_db'] > 0:
+        return '[%d/%d] warning\nReason: %.1f dB over.\n' % (i + 1,
+                                                len(tasks), task['peak_db'])
+    return ''
+
+
+def _create_wav(fname, wavfmt, nchannels, fs, nframes):
+    # create WAV file of nframes (filled later, see _export_segment())
+    # and return the offset of the data
+    sampwidth, is_float = wavfmt
+    with open(fname, 'wb') as f:
+        return wavfile.create(f, nchannels, sampwidth, fs, nframes,
+                                                    CONTAINER, is_float)
+
+
+_worker = {}
+
+def _settings(threads):
+    # the settings of the modules in this process, which the units and
+    # segments are made with (the spawned workers import the defaults)
+    # return: {module name: {name: value}}, see _init_worker()
+    return {
+        'batch': {'THREADS': threads, 'CONTAINER': CONTAINER,
+                                                'OFFLINE_MEM': OFFLINE_MEM},
+        'fftbackend': {'BACKEND': fftbackend.BACKEND,
+                                    'MEASURE_MAX': fftbackend.MEASURE_MAX},
+        'fircache': {'cache': fircache.cache},
+    }
+
+def _init_worker(progress, canceled, pool_size, settings):
+    # initializer of the worker processes of _export_parallel()
+    # (settings: see _settings())
+    modules = {'batch': sys.modules[__name__], 'fftbackend': fftbackend,
+                                                        'fircache': fircache}
+    for name, values in settings.items():
+        vars(modules[name]).update(values)
+    _worker['progress'] = progress
+    _worker['canceled'] = canceled
+    _worker['pool'] = fircache.SpectrumPool(pool_size)
+
+
+class _WorkerProgress:
+    # stands for QProgressDialog in the worker processes
+    # (the progress of job j, see _export_parallel())
+
+    def __init__(self, j):
+        self.j = j
+        self.maximum = 1
+
+    def wasCanceled(self):
+        return _worker['canceled'].is_set()
+
+    def setRange(self, minimum, maximum):
+        self.maximum = max(maximum, 1)
+
+    def setValue(self, value):
+        _worker['progress'][self.j] = value / self.maximum
+
+
+def _unit_failed(tasks, unit, e):
+    # error log of tasks[unit] (e.g. the worker process died)
+    error_log = ''
+    for i in unit:
+        error_log += '[%d/%d] failed\n' % (i + 1, len(tasks))
+        error_log += 'Reason: %s\n' % e
+        tasks[i]['playmark'] = '!'
+    return error_log
 
-def float2buffer_16bit(data): # 1-dim input
-    data *= 32768
-    np.clip(data, -32768, 32767, out=data)
-    return data.astype(np.int16).tostring()
 
-def float2buffer_24bit(data): # 1-dim input
-    data *= 8388608
-    np.clip(data, -8388608, 8388607, out=data)
-    a32 = np.asarray(data, dtype=np.int32)
-    a8 = (a32.reshape(a32.shape + (1,)) >> np.array([0, 8, 16])) & 255
-    return a8.astype(np.uint8).tostring()
+def _unit_mem(tasks, unit, N_str, dtype):
+    # estimated memory to export tasks[unit] (bytes)
+    tasks_fir = [tasks[i] for i in unit if tasks[i]['path2fir'] != '']
+    if not tasks_fir:
+        return 0
+    try:
+        with wavfile.WavReader(tasks_fir[0]['path2src']) as wf:
+            nchannels, nframes = wf.getnchannels(), wf.getnframes()
+        shapes = [np.load(task['path2fir'], 'r').shape for task in tasks_fir]
+    except Exception:
+        return 0 # fails soon
+
+    if N_str == 'auto':
+        L = overlap_add_block(shapes, nchannels, nframes, dtype, OFFLINE_MEM)
+        if L is not None:
+            return overlap_add_mem(shapes, nchannels, L, dtype)
+
+    # partitioned: the FIR, its spectra, and the delay line (twice the
+    # spectra of the input)
+    r = np.dtype(dtype).itemsize
+    c = np.dtype(np.result_type(dtype, np.complex64)).itemsize
+    shape = shapes[0]
+    n_fir = 1 if len(shape) == 1 else shape[0] * shape[1]
+    return shape[-1] * ((r + c) * n_fir + 2 * c * nchannels)
+
+
+def _export_mem():
+    # memory for parallel export (bytes)
+    if EXPORT_MEM is not None:
+        return EXPORT_MEM
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+
+def _fname(task):
+    # output file name of task
+    src_base = os.path.splitext(os.path.basename(task['disp_src']))[0]
+    fir_base = os.path.splitext(os.path.basename(task['disp_fir']))[0]
+    
+    fname = '%s_%.1fdB' % (src_base, task['gain_src_db'])
+    if fir_base:
+        fname += '_%s_%.1fdB' % (fir_base, task['gain_fir_db'])
+    fname += '.w64' if CONTAINER == 'w64' else '.wav'
+    return fname
+
+
+def _threads():
+    # THREADS as the number of threads
+    return THREADS if THREADS > 0 else os.cpu_count() or 1
+
+
+def _engine(fir_shape, nchannels, nframes, N_str, dtype, fft):
+    # convolution engine of ConvGenerator and its block size
+    # ('single' or 'overlap-add', L): OverlapAdd (FFT point 'auto')
+    # ('partitioned', N): OverlapSave(MIMO), FFT point 2N
+    if N_str == 'auto':
+        L = overlap_add_block([fir_shape], nchannels, nframes, dtype,
+                                                                OFFLINE_MEM)
+        if L is not None:
+            return ('single' if L >= nframes else 'overlap-add'), L
+        fftpoint = 2 * autotune.tuner.best_chunksize(
+                            fir_shape, nchannels, nframes, dtype, fft)
+    elif 'nextpow2+' in N_str:
+        n = int(N_str.split('+')[1])
+        nextpow2 = int(np.ceil(np.log2(fir_shape[-1])))
+        fftpoint = 2 ** (nextpow2 + n)
+    else:
+        fftpoint = int(N_str)
+    return 'partitioned', fftpoint // 2
+
+
+def _warmup(engine, chunksize, len_fir):
+    # the number of the preceding blocks that reach the output of a block
+    # OverlapAdd: a block is added to the output of the next n_fft samples
+    # OverlapSave: the previous block and P partitions
+    if engine == 'partitioned':
+        return int(np.ceil(len_fir / chunksize)) + 1
+    n_fft = fftbackend.next_fast_len(chunksize + len_fir - 1)
+    return int(np.ceil(n_fft / chunksize))
+
+
+def _pool_key(config, fir, dtype, engine, fftpoint):
+    # key of SpectrumPool (the spectra do not depend on the source)
+    return (os.path.realpath(config['path2fir']), fir.shape,
+                                np.dtype(dtype).name, engine, fftpoint)
+
+
+def _float2buffer(wavfmt):
+    # float -> frames (the array is reused by the next call, see pcm)
+    # wavfmt: (sampwidth, is_float)
+    return pcm.Encoder(*wavfmt)
+
+
+def _group(tasks, first, done, dtype):
+    # indices of tasks convolved together with tasks[first]
+    # (the same source, with FIR and not muted, and the FIRs fit in
+    # OFFLINE_MEM together)
+    try:
+        with wavfile.WavReader(tasks[first]['path2src']) as wf:
+            nchannels, nframes = wf.getnchannels(), wf.getnframes()
+    except Exception:
+        return [first]
+
+    group = []
+    shapes = []
+    for i in range(first, len(tasks)):
+        task = tasks[i]
+        if (i in done or task['path2src'] != tasks[first]['path2src']
+                or task['path2fir'] == '' or task['gain_src'] == 0
+                or task['gain_fir'] == 0):
+            continue
+        try:
+            shape = np.load(task['path2fir'], 'r').shape
+        except Exception:
+            continue
+        if overlap_add_block(shapes + [shape], nchannels, nframes, dtype,
+                                                    OFFLINE_MEM) is None:
+            continue
+        group.append(i)
+        shapes.append(shape)
+    return group if group else [first]
 
-def float2buffer_32bit(data): # 1-dim input
-    data *= 2147483648
-    np.clip(data, -2147483648, 2147483647, out=data)
-    return data.astype(np.int32).tostring()
+
+def _export_group(tasks, group, path, wavfmt, qprog, dtype, trim_db,
+                                                                    pool):
+    # export tasks[group] with GroupGenerator, and return error log
+    error_log = ''
+    num_tasks = len(tasks)
+    number = {id(tasks[i]): i + 1 for i in group} # task number in log
+    
+    try:
+        gene = GroupGenerator([tasks[i] for i in group], dtype, trim_db, pool)
+    except Exception as e:
+        for i in group:
+            error_log += '[%d/%d] failed\n' % (i + 1, num_tasks)
+            error_log += 'Reason: %s\n' % e
+            tasks[i]['playmark'] = '!'
+        return error_log
+
+    for task, e in gene.failed:
+        error_log += '[%d/%d] failed\n' % (number[id(task)], num_tasks)
+        error_log += 'Reason: %s\n' % e
+        task['playmark'] = '!'
+    if not gene.configs:
+        return error_log
+    
+    if qprog.wasCanceled():
+        return error_log
+
+    # process
+    label = '\nExport [%s/%d]\n' % (
+            ','.join('%d' % number[id(task)] for task in gene.configs),
+            num_tasks)
+    label += 'Source: %s\n' % gene.configs[0]['disp_src']
+    label += 'Channels: %d\n' % gene.nchannels_src
+    for task, shape in zip(gene.configs, gene.fir_shapes):
+        label += 'FIR: %s %s --> %s\n' % (task['disp_fir'], shape,
+                                                            _fname(task))
+    label += 'FFTpoint: %s' % gene.fftpoint
+    _set_label(qprog, label)
+
+    float2buffer = _float2buffer(wavfmt)
+    sampwidth, is_float = wavfmt
+    writers = []
+    try:
+        for task, ch_out, nframes in zip(gene.configs, gene.nchannels_out,
+                                                        gene.nframes_out):
+            writers.append(wavfile.WavWriter(path + _fname(task), ch_out,
+                        sampwidth, gene.fs, nframes, CONTAINER, is_float))
+            task['peak'] = 0
+            task['peak_db'] = -np.inf
+        qprog.setRange(0, gene.n_loop)
+        for n in range(gene.n_loop):
+            if qprog.wasCanceled():
+                break
+            qprog.setValue(n)
+            for ww, data in zip(writers, gene.calc()):
+                ww.writeframes(float2buffer(data))
+        while writers:
+            writers.pop(0).close()
+
+    except Exception as e:
+        for ww in writers:
+            try:
+                ww.close()
+            except Exception:
+                pass
+        for task in gene.configs:
+            error_log += '[%d/%d] failed\n' % (number[id(task)], num_tasks)
+            error_log += 'Reason: %s\n' % e
+            task['playmark'] = '!'
+        return error_log
+
+    # peak warning
+    for task in gene.configs:
+        if task['peak_db'] > 0:
+            error_log += '[%d/%d] warning\n' % (number[id(task)], num_tasks)
+            error_log += 'Reason: %.1f dB over.\n' % (task['peak_db'])
+
+    return error_log
 
 
 
 class WavGenerator(player.WavGenerator):
     
-    def __init__(self, config):
+    def __init__(self, config, dtype=np.float64):
         
         self.config = config
-        self.wf = wave.open(config['path2src'], 'rb')
+        self.dtype = dtype
+        self.wf = wavfile.WavReader(config['path2src'])
 
         self.fs = self.wf.getframerate()
         self.ws = self.wf.getsampwidth()
         self.nframes = self.wf.getnframes()
         self.nchannels_src = self.wf.getnchannels()
         self.nchannels_out = self.nchannels_src
+        self.nframes_out = self.nframes # (see wavfile.WavWriter)
 
         self.bytes_per_frame_src = self.nchannels_src * self.ws
 
-        if self.ws == 2:
-            self.buffer2float = self.buffer2float_16bit
-        elif self.ws == 3:
-            self.buffer2float = self.buffer2float_24bit
-        elif self.ws == 4:
-            self.buffer2float = self.buffer2float_32bit
-        else:
-            raise Exception ('Unsupported wave format')
+        # frames -> float (the array is reused by the next call)
+        self.buffer2float = pcm.Decoder(self.ws, dtype, self.wf.is_float)
         
         #
         self.fftpoint = ''
@@ -198,26 +762,22 @@ class WavGenerator(player.WavGenerator):
 
 class ConvGenerator(WavGenerator):
 
-    def __init__(self, config, N_str):
-        super().__init__(config)
+    def __init__(self, config, N_str, dtype=np.float64, trim_db=None, lsb=0,
+                                                    pool=None, engine=None):
+        # engine: (engine, block size) of _engine() instead of N_str
+        super().__init__(config, dtype)
+        if pool is None:
+            pool = fircache.SpectrumPool()
         
         # try to import FIR filter
         fir = np.load(config['path2fir'], 'r')
 
-        # decide chunksize according to N_str
-        len_fir = fir.shape[-1]
-        if 'nextpow2+' in N_str:
-            n = int(N_str.split('+')[1])
-            nextpow2 = int(np.ceil(np.log2(len_fir)))
-            fftpoint = 2 ** (nextpow2 + n)
-        else:
-            fftpoint = int(N_str)
-        self.chunksize = fftpoint // 2
+        # trim negligible tail (below trim_db relative to the total energy)
+        if trim_db is not None:
+            fir = fir[..., :trim_length(fir, trim_db)]
 
-        # set convolver
         if fir.ndim == 1:
             print('SISO')
-            self.os = OverlapSave(fir, self.chunksize, self.nchannels_src)
             self.mode = 'SISO'
         elif fir.ndim == 3:
             print('MIMO')
@@ -225,28 +785,96 @@ class ConvGenerator(WavGenerator):
                 msg = 'channel mismatch: source %d-out >> FIR %d-in'\
                                         % (self.nchannels_src, fir.shape[1])
                 raise Exception(msg)
-
-            self.os = OverlapSaveMIMO(fir, self.chunksize)
             self.nchannels_out = fir.shape[0]
             self.mode = 'MIMO'
         else:
             raise Exception('Invalid FIR shape')
 
+        # engine
+        len_fir = fir.shape[-1]
+        fft = fftbackend.get(workers=THREADS)
+        if engine is None:
+            engine = _engine(fir.shape, self.nchannels_src, self.nframes,
+                                                        N_str, dtype, fft)
+        self.engine, self.chunksize = engine
+        if self.engine == 'partitioned':
+            self._set_partitioned(config, fir, dtype, fft, pool)
+        else:
+            L = self.chunksize
+            n_fft = fftbackend.next_fast_len(L + len_fir - 1)
+            self.os = pool.build(_pool_key(config, fir, dtype, 'OA', n_fft),
+                    lambda spectra: OverlapAdd(fir, L, self.nchannels_src,
+                                            dtype, fft, n_fft, spectra))
+            self.fftpoint = '%d (%s)' % (n_fft, self.engine)
+
         # nblocks and count
         len_out = self.nframes + len_fir - 1
         self.n_loop = int(np.ceil(len_out / self.chunksize))
-        self.fftpoint = '%d' % (self.chunksize * 2)
+        self.nframes_out = len_out
         self.fir_shape = str(fir.shape)
+
+        # early termination (see _below_lsb())
+        self.lsb = lsb
+        if lsb > 0:
+            self.tail_l1 = tail_l1(fir, self.chunksize)
+            self.x_max = np.zeros(self.nchannels_src)
+        self.n_out = 0
+        self.silent = False
+
+    def _set_partitioned(self, config, fir, dtype, fft, pool):
+        # uniformly partitioned convolver (N = chunksize)
+        fftpoint = 2 * self.chunksize
+        self.fftpoint = '%d' % fftpoint
+
+        # (the spectra from the pool, otherwise from the disk cache)
+        if fir.ndim == 1:
+            cls, args = OverlapSave, (fir, self.chunksize, self.nchannels_src)
+            kwargs = dict(dtype=dtype, fft=fft)
+        else:
+            cls, args = OverlapSaveMIMO, (fir, self.chunksize)
+            kwargs = dict(dtype=dtype, fft=fft, threads=_threads())
+
+        def make(spectra):
+            if spectra is None:
+                return fircache.cache.build(config['path2fir'], cls,
+                                                            *args, **kwargs)
+            return cls(*args, spectra=spectra, **kwargs)
+
+        self.os = pool.build(_pool_key(config, fir, dtype, 'OS', fftpoint),
+                                                                        make)
         
 
+    def seek_block(self, n):
+        # start from block n (for a segment, see _export_segment())
+        # The convolver is run through the preceding blocks that reach
+        # block n (see _warmup()) with the output discarded, so that the
+        # output is the same as rendered from the beginning.
+        # (not with lsb, which needs the input before them)
+        n_0 = max(n - _warmup(self.engine, self.chunksize,
+                                                    self.os.len_fir), 0)
+        self.os.clear_buffer()
+        self.wf.setpos(n_0 * self.chunksize)
+        for i in range(n_0, n):
+            self.len_buf = self.os.conv(self._read())[1]
+        self.n_out = n * self.chunksize
+
     def calc(self):
-        frames = self.wf.readframes(self.chunksize)
-        data = self.buffer2float(frames)
-        data *= self.config['gain_src']
-        
-        data = data.reshape([self.nchannels_src, -1], order='F')
+        if self.silent:
+            # the rest of output is below LSB
+            self.len_buf -= self.chunksize
+            L = np.clip(self.len_buf, 0, self.chunksize)
+            return np.zeros(L * self.nchannels_out, dtype=self.dtype)
+
+        data = self._read()
+        if self.lsb > 0 and data.shape[1] > 0:
+            np.maximum(self.x_max, np.abs(data).max(axis=1), out=self.x_max)
         data_out, len_buf = self.os.conv(data)
 
+        self.len_buf = len_buf
+        self.n_out += self.chunksize
+        if self.lsb > 0 and self.n_out >= self.nframes:
+            self.silent = self._below_lsb()
+
         if len_buf > 0:
             data_out *= self.config['gain_fir']
             self._detect_peak(data_out)
@@ -254,4 +882,114 @@ class ConvGenerator(WavGenerator):
         else:
             return data_out[:, :0].reshape(-1, order='F')
 
+    def _read(self):
+        # next block of the source [ch, chunksize] (with gain_src)
+        frames = self.wf.readframes(self.chunksize)
+        data = self.buffer2float(frames)
+        data *= self.config['gain_src']
+        return data.reshape([self.nchannels_src, -1], order='F')
+
+    def _below_lsb(self):
+        # True if the output from n_out is provably below LSB / 2
+        #
+        # After the source ends (nframes), the output is bounded by
+        # |y[n]| <= gain_fir * sum_i max|x_i| * sum_{k>=m} |h_i[k]|,
+        # where m = n - nframes + 1 (see tail_l1()).
+
+        b = (self.n_out - self.nframes + 1) // self.chunksize
+        if b >= self.tail_l1.shape[-1]:
+            return True
+        if self.mode == 'SISO':
+            bound = self.x_max.max() * self.tail_l1[b]
+        else:
+            bound = (self.tail_l1[:, :, b] @ self.x_max).max()
+        bound *= self.config['gain_fir']
+        return bound < self.lsb / 2
+
+
+
+class GroupGenerator(WavGenerator):
+    # Convolution of a source with the FIRs of several tasks
+    #
+    # Each block of the source is decoded and transformed once, and the
+    # spectrum is shared by OverlapAdd of all FIRs (with the FFT size of
+    # the longest one). The gains are applied after the convolution.
+    # calc() returns the output blocks of all tasks.
+    #
+    # configs: tasks of the same source
+    # self.configs: tasks to be exported
+    # self.failed: [(task, exception)] of FIRs that cannot be loaded
+
+    def __init__(self, configs, dtype=np.float64, trim_db=None, pool=None):
+        super().__init__(configs[0], dtype)
+        if pool is None:
+            pool = fircache.SpectrumPool()
+
+        self.configs = []
+        self.failed = []
+        firs = []
+        for config in configs:
+            try:
+                fir = np.load(config['path2fir'], 'r')
+                if trim_db is not None:
+                    fir = fir[..., :trim_length(fir, trim_db)]
+                if fir.ndim == 3 and fir.shape[1] != self.nchannels_src:
+                    msg = 'channel mismatch: source %d-out >> FIR %d-in'\
+                                    % (self.nchannels_src, fir.shape[1])
+                    raise Exception(msg)
+                elif fir.ndim != 1 and fir.ndim != 3:
+                    raise Exception('Invalid FIR shape')
+            except Exception as e:
+                self.failed.append((config, e))
+                continue
+            self.configs.append(config)
+            firs.append(fir)
+        if not firs:
+            return
+
+        # OverlapAdd of the same L and FFT size
+        shapes = [fir.shape for fir in firs]
+        L = overlap_add_block(shapes, self.nchannels_src, self.nframes,
+                                                        dtype, OFFLINE_MEM)
+        if L is None:
+            raise Exception('FIRs exceed the memory for export')
+        len_fir = max(fir.shape[-1] for fir in firs)
+        n_fft = fftbackend.next_fast_len(L + len_fir - 1)
+        fft = fftbackend.get(workers=THREADS)
+        self.os = []
+        for config, fir in zip(self.configs, firs):
+            self.os.append(pool.build(
+                    _pool_key(config, fir, dtype, 'OA', n_fft),
+                    lambda spectra: OverlapAdd(fir, L, self.nchannels_src,
+                                            dtype, fft, n_fft, spectra)))
+
+        self.chunksize = L
+        self.n_loop = int(np.ceil((self.nframes + len_fir - 1) / L))
+        self.nchannels_out = [c.ch_out for c in self.os]
+        self.nframes_out = [self.nframes + c.len_fir - 1 for c in self.os]
+        self.fir_shapes = [str(shape) for shape in shapes]
+        self.fftpoint = '%d (shared by %d FIRs)' % (n_fft, len(firs))
 
+    def calc(self):
+        frames = self.wf.readframes(self.chunksize)
+        data = self.buffer2float(frames)
+        data = data.reshape([self.nchannels_src, -1], order='F')
+        len_in = data.shape[1]
+        x_f = self.os[0].transform(data) if len_in != 0 else None
+
+        outputs = []
+        for c, config in zip(self.os, self.configs):
+            data_out, len_buf = c.conv_f(x_f, len_in)
+            data_out = data_out[:, :max(len_buf, 0)]
+            data_out *= config['gain_src'] * config['gain_fir']
+            self._detect_peak(data_out, config)
+            outputs.append(data_out.reshape(-1, order='F'))
+        return outputs
+
+    def _detect_peak(self, data, config):
+        if data.size == 0:
+            return
+        peak = np.max(np.abs(data))
+        if peak > config['peak']:
+            config['peak'] = peak
+            config['peak_db'] = 20 * np.log10(peak)
@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import numpy as np
+
+from convolution import OverlapSaveMIMO, NonUniformOverlapSave
+import pcm
+
+
+# Benchmarks of the convolution engine
+#
+# usage: python benchmark.py mimo [ch len_fir N]
+#        python benchmark.py pcm [n_samples]
+#        python benchmark.py partition [N max_partition lookahead]
+
+
+
+def mimo_threads(ch=64, len_fir=8192, N=1024, fs=48000, dtype=np.float32,
+                                                            repeat=20):
+    # time per block of OverlapSaveMIMO (ch-in/ch-out) with 1 .. cores
+    # threads, and the load relative to the block period at fs
+    rng = np.random.default_rng(0)
+    fir = rng.standard_normal([ch, ch, len_fir]).astype(dtype)
+    x = rng.standard_normal([ch, N]).astype(dtype)
+
+    print('MIMO %d-in/%d-out, FIR %d, N %d, %s'
+                            % (ch, ch, len_fir, N, np.dtype(dtype).name))
+    print('threads  time/block  speedup  load')
+    t_1 = None
+    for threads in range(1, (os.cpu_count() or 1) + 1):
+        c = OverlapSaveMIMO(fir, N, dtype=dtype, threads=threads)
+        c.conv(x)
+        t = time.perf_counter()
+        for i in range(repeat):
+            c.conv(x)
+        t = (time.perf_counter() - t) / repeat
+        if t_1 is None:
+            t_1 = t
+        print('%7d  %7.2f ms  %6.2fx  %3.0f %%'
+                % (threads, t * 1000, t_1 / t, t / (N / fs) * 100))
+
+
+def partition(N=512, max_partition=8192, lookahead=4, len_fir=480000,
+                                fs=48000, dtype=np.float32, seconds=30):
+    # load per block of NonUniformOverlapSave (stereo source) against
+    # the uniform one, and the blocks late for the callback when they
+    # are rendered lookahead blocks ahead (see player.ConvGenerator)
+    rng = np.random.default_rng(0)
+    fir = rng.standard_normal(len_fir).astype(dtype) * 0.01
+    x = rng.standard_normal([2, N]).astype(dtype)
+    n_block = int(seconds * fs / N)
+    period = N / fs
+
+    print('stereo, FIR %d (%.1f s), N %d (%.1f ms), %s, %d blocks'
+            % (len_fir, len_fir / fs, N, period * 1000,
+                                        np.dtype(dtype).name, n_block))
+    print('max_partition  average  worst (99.5 %%)  late (lookahead 0/%d)'
+                                                                % lookahead)
+    for M in (N, max_partition):
+        c = NonUniformOverlapSave(fir, N, 2, M, dtype=dtype)
+        for i in range(2 * M // N):
+            c.conv(x)
+        t = np.zeros(n_block)
+        for i in range(n_block):
+            t_0 = time.perf_counter()
+            c.conv(x)
+            t[i] = time.perf_counter() - t_0
+        print('%13d  %5.0f %%  %9.0f %%     %6d / %d'
+                % (M, t.mean() / period * 100,
+                    np.percentile(t, 99.5) / period * 100,
+                    np.count_nonzero(t > period),
+                    _late(t, period, lookahead)))
+
+
+def _late(t, period, lookahead):
+    # the number of blocks not rendered by their callback
+    # Block i is played at (i + lookahead) * period (the ring is filled
+    # before the stream starts), and can be rendered when block
+    # i - lookahead has been played, one after another.
+    done = 0
+    late = 0
+    for i, t_i in enumerate(t):
+        done = max(done, i * period) + t_i
+        if done > (i + lookahead) * period:
+            late += 1
+    return late
+
+
+def pcm_codec(n=2 ** 16, dtype=np.float64, repeat=50):
+    # throughput of pcm (decode/encode of n samples) against the previous
+    # conversion of player/batch (_old_decode(), _old_encode())
+    rng = np.random.default_rng(0)
+    x = (rng.standard_normal(n) * 0.3).astype(dtype)
+    out = np.zeros(n, dtype=dtype)
+    scratch = np.zeros(n, dtype='<i4')
+
+    print('PCM codec, %d samples, %s (Msamples/s)'
+                                        % (n, np.dtype(dtype).name))
+    print('format   decode old/new     encode old/new')
+    for sampwidth in (2, 3, 4):
+        frames = rng.integers(0, 256, n * sampwidth, dtype=np.uint8)
+        frames_bytes = frames.tobytes()
+        buf = np.zeros(n * sampwidth, dtype=np.uint8)
+        decode = pcm.decoder(sampwidth)
+        encode = pcm.encoder(sampwidth)
+        t = [_best(lambda: _old_decode(frames_bytes, sampwidth, dtype),
+                                                                    repeat),
+             _best(lambda: decode(frames, out, scratch), repeat),
+             _best(lambda: _old_encode(x.copy(), sampwidth), repeat),
+             _best(lambda: encode(x.copy(), buf, scratch), repeat)]
+        t[2] -= _best(lambda: x.copy(), repeat)
+        t[3] -= _best(lambda: x.copy(), repeat)
+        print('%2d bit   %6.0f  %6.0f      %6.0f  %6.0f'
+                % ((8 * sampwidth,) + tuple(n / 1e6 / s for s in t)))
+
+
+def _old_decode(frames, sampwidth, dtype):
+    # player.WavGenerator.buffer2float_* before pcm
+    if sampwidth == 2:
+        a16 = np.frombuffer(frames, dtype=np.int16)
+        return np.multiply(a16, 1 / 32768, dtype=dtype)
+    elif sampwidth == 3:
+        a8 = np.frombuffer(frames, dtype=np.uint8)
+        tmp = np.zeros((a8.shape[0] // 3, 4), dtype=np.uint8)
+        tmp[:, 1:] = a8.reshape(-1, 3)
+        return np.multiply(tmp.view(np.int32)[:, 0], 1 / 2147483648,
+                                                                dtype=dtype)
+    a32 = np.frombuffer(frames, dtype=np.int32)
+    return np.multiply(a32, 1 / 2147483648, dtype=dtype)
+
+
+def _old_encode(data, sampwidth):
+    # batch.float2buffer_* before pcm
+    if sampwidth == 2:
+        data *= 32768
+        np.clip(data, -32768, 32767, out=data)
+        return data.astype(np.int16).tobytes()
+    elif sampwidth == 3:
+        data *= 8388608
+        np.clip(data, -8388608, 8388607, out=data)
+        a32 = np.asarray(data, dtype=np.int32)
+        a8 = (a32.reshape(a32.shape + (1,)) >> np.array([0, 8, 16])) & 255
+        return a8.astype(np.uint8).tobytes()
+    data *= 2147483648
+    upper = np.nextafter(data.dtype.type(2147483648), data.dtype.type(0))
+    np.clip(data, -2147483648, upper, out=data)
+    return data.astype(np.int32).tobytes()
+
+
+def _best(func, repeat):
+    # best time of repeated calls (seconds)
+    func()
+    best = np.inf
+    for i in range(repeat):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'mimo':
+        args = [int(a) for a in sys.argv[2:5]]
+        mimo_threads(*args)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'pcm':
+        args = [int(a) for a in sys.argv[2:3]]
+        pcm_codec(*args)
+        pcm_codec(*args, dtype=np.float32)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'partition':
+        args = [int(a) for a in sys.argv[2:5]]
+        partition(*args)
+    else:
+        print('usage: python benchmark.py mimo [ch len_fir N]')
+        print('       python benchmark.py pcm [n_samples]')
+        print('       python benchmark.py partition [N max_partition '
+                                                            'lookahead]')
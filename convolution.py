@@ -1,5 +1,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+
+import fftbackend
+
+
+# relative cost of a sub-filter in the sparse MIMO path (see _sparse())
+SPARSE_COST = 4
 
 
 
@@ -9,49 +16,77 @@ class OverlapSave:
     # SISO FIR is applied in parallel to all channels.
     # fir.ndim should be 1.
     # FIR longer than N is automatically chunked.
-
-    def __init__(self, fir, N, channel):
+    # The output is delayed by N * delay samples.
+    # dtype is the real data type of the processing (float64/float32).
+    # fft is the FFT backend (default: fftbackend.get()).
+    #
+    # The spectra of the input blocks are kept in one frequency-domain
+    # delay line (FDL), and all partitions are accumulated from it.
+
+    def __init__(self, fir, N, channel, delay=0, dtype=np.float64,
+                                                fft=None, spectra=None):
         if fir.ndim != 1:
             raise Exception('invalid fir shape')
 
         self.N = N
         self.len_fir = fir.shape[-1]
+        self.delay = delay
+        self.dtype = dtype
+        self.cdtype = np.result_type(dtype, np.complex64)
+        self.fft = fft if fft is not None else fftbackend.get()
 
-        # split FIR
-        fir_split = []
-        ss = 0
-        while ss < fir.shape[-1]:
-            fir_split.append(fir[ss:ss + N])
-            ss += N
-        
-        # instantiate convolver
-        self.c = []
-        for i in range(len(fir_split)):
-            self.c.append(_Convolver(fir_split[i], N, channel, i))
+        # FIR (frequency domain)
+        # The spectra can be given, e.g. from SpectrumCache.
+        self.P = int(np.ceil(self.len_fir / N))
+        if spectra is None:
+            self.fir_f = self._transform(fir)
+        else:
+            self.fir_f = spectra[0]
+
+        # frequency-domain delay line
+        # fdl: [freq, 2 * (partition + delay), channel]
+        # Every spectrum is written twice (i and i + len_fdl), so that
+        # the latest P spectra are always a contiguous slice.
+        self.len_fdl = self.P + delay
+        self.fdl = np.zeros([N + 1, 2 * self.len_fdl, channel],
+                                                    dtype=self.cdtype)
+        self.i_fdl = 0
         
         # input buffer
-        self.in_buf = np.zeros([channel, 2 * N])
+        self.in_buf = np.zeros([channel, 2 * N], dtype=dtype)
         
         # output
-        self.out_f = np.zeros([channel, N + 1], dtype=np.complex)
+        # out_f: [freq, 1, channel]
+        self.out_f = np.zeros([N + 1, 1, channel], dtype=self.cdtype)
+        self.out = np.zeros([channel, N], dtype=dtype)
 
         # buffering length
         self.len_buf = self.N
         
     def conv(self, x):
+        self.push(x)
+
+        # convolution
+        self._mac()
+
+        return self.out, self.len_buf
+
+    def push(self, x):
+        # input a block without computing the output (see conv())
 
         # shifted into buffer
+        # (row by row, since numpy copies the overlapping 2-dim slices)
         len_in = x.shape[-1]
-        self.in_buf[:, :self.N] = self.in_buf[:, self.N:]
+        for row in self.in_buf:
+            row[:self.N] = row[self.N:]
         self.in_buf[:, self.N:self.N + len_in] = x
         self.in_buf[:, self.N + len_in:] = 0
 
-        # convolution
-        in_f = np.fft.rfft(self.in_buf)
-        self.out_f[:] = 0
-        for c_ in self.c:
-            self.out_f[:] += c_.conv(in_f)
-        out = np.fft.irfft(self.out_f)[:, :self.N]
+        # newest spectrum into delay line
+        self.i_fdl = (self.i_fdl - 1) % self.len_fdl
+        in_f = self.fft.rfft(self.in_buf).T
+        self.fdl[:, self.i_fdl] = in_f
+        self.fdl[:, self.i_fdl + self.len_fdl] = in_f
 
         # buffering length
         if len_in != 0:
@@ -59,38 +94,31 @@ class OverlapSave:
         else:
             self.len_buf -= self.N
 
-        return out, self.len_buf
+    def _mac(self):
+        # multiply-accumulate over all partitions, and inverse transform
+        j = self.i_fdl + self.delay
+        np.matmul(self.fir_f, self.fdl[:, j:j + self.P], out=self.out_f)
+        out_f = self.out_f[:, 0].T
+        self.out[:] = self.fft.irfft(out_f, 2 * self.N)[:, :self.N]
             
     
     def clear_buffer(self):
-        for c_ in self.c:
-            c_.out_f_buf[:] = 0
+        self.in_buf[:] = 0
+        self.fdl[:] = 0
 
+    def get_spectra(self):
+        return [self.fir_f]
 
-class _Convolver:
-
-    def __init__(self, fir, N, channel, schedule):
-        self.N = N
-        self.schedule = schedule
-
-        # FIR (frequency domain)
-        fir_zeropad = np.zeros(2 * N)
-        fir_zeropad[N:N + fir.shape[-1]] = fir
-        self.fir_f = np.fft.rfft(fir_zeropad)
-        
-        # output buffer delay output timing by N * schedule
-        self.out_f_buf = np.zeros([schedule + 1, channel, N + 1],
-                                                        dtype=np.complex)
-        self.i_buf = 0
-        
-    def conv(self, x_f):
-        # convolution
-        self.out_f_buf[self.i_buf] = self.fir_f * x_f
-        # index ring buffer
-        self.i_buf += 1
-        if self.i_buf > self.schedule:
-            self.i_buf = 0
-        return self.out_f_buf[self.i_buf]
+    def _transform(self, fir):
+        # split FIR and transform (zero-padded to 2N)
+        # return: [freq, 1, partition]
+        N = self.N
+        fir_zeropad = np.zeros([self.P, 2 * N])
+        for i in range(self.P):
+            fir_i = fir[i * N:(i + 1) * N]
+            fir_zeropad[i, N:N + fir_i.shape[-1]] = fir_i
+        fir_f = self.fft.rfft(fir_zeropad).T.reshape(N + 1, 1, self.P)
+        return np.array(fir_f, dtype=self.cdtype, order='C')
 
 
 
@@ -101,55 +129,98 @@ class OverlapSaveMIMO:
     # N-point overlap-save convolution
     # 
     # MIMO FIR is applied.
-    # fir.ndim should be 1.
+    # fir.ndim should be 3.
     # FIR longer than N is automatically chunked.
-
-    def __init__(self, fir, N):
+    # The output is delayed by N * delay samples.
+    # dtype is the real data type of the processing (float64/float32).
+    # fft is the FFT backend (default: fftbackend.get()).
+    #
+    # The spectra of the input blocks are kept in one frequency-domain
+    # delay line (FDL), and all partitions are accumulated from it.
+    #
+    # Sub-filters (route and partition) that are all zero are detected,
+    # and skipped if it is cheaper (see _sparse()).
+    #
+    # With threads > 1, the MAC is split into frequency bands computed
+    # in parallel (NumPy releases the GIL). Each bin is computed by one
+    # thread in the same way, so the output does not depend on threads.
+
+    def __init__(self, fir, N, delay=0, dtype=np.float64, fft=None,
+                                                spectra=None, threads=1):
         if fir.ndim != 3:
             raise Exception('invalid fir shape')
 
         self.N = N
         self.len_fir = fir.shape[-1]
+        self.delay = delay
+        self.dtype = dtype
+        self.cdtype = np.result_type(dtype, np.complex64)
+        self.fft = fft if fft is not None else fftbackend.get()
 
         ch_out = fir.shape[0]
         ch_in = fir.shape[1]
 
-        # split FIR
-        fir_split = []
-        ss = 0
-        while ss < fir.shape[-1]:
-            fir_split.append(fir[:, :, ss:ss + N])
-            ss += N
-        
-        # instantiate convolver
-        self.c = []
-        for i in range(len(fir_split)):
-            self.c.append(_ConvolverMIMO(fir_split[i], N, i))
+        # FIR (frequency domain)
+        # The spectra can be given, e.g. from SpectrumCache.
+        self.P = int(np.ceil(self.len_fir / N))
+        if spectra is None:
+            self.fir_f = self._transform(fir)
+        else:
+            self.fir_f = spectra[0]
+        self.sparse = self._sparse()
+
+        # frequency-domain delay line
+        # fdl: [freq, 2 * (partition + delay), ch_in]
+        # Every spectrum is written twice (i and i + len_fdl), so that
+        # the latest P spectra are always a contiguous slice.
+        self.len_fdl = self.P + delay
+        self.fdl = np.zeros([N + 1, 2 * self.len_fdl, ch_in],
+                                                    dtype=self.cdtype)
+        self.i_fdl = 0
         
         # input buffer
-        self.in_buf = np.zeros([ch_in, 1, 2 * N])
+        self.in_buf = np.zeros([ch_in, 2 * N], dtype=dtype)
         
         # output
-        self.out_f = np.zeros([ch_out, N + 1], dtype=np.complex)
+        # out_f: [freq, ch_out, 1]
+        self.out_f = np.zeros([N + 1, ch_out, 1], dtype=self.cdtype)
+        self.out = np.zeros([ch_out, N], dtype=dtype)
+
+        # frequency bands of threads
+        self.threads = max(min(threads, N + 1), 1)
+        edges = np.linspace(0, N + 1, self.threads + 1).astype(int)
+        self.bands = [slice(a, b) for a, b in zip(edges[:-1], edges[1:])]
+        if self.threads > 1:
+            self.pool = _pool(self.threads - 1)
 
         # buffering length
         self.len_buf = self.N
 
 
     def conv(self, x):
+        self.push(x)
+
+        # convolution
+        self._mac()
+
+        return self.out, self.len_buf
+
+    def push(self, x):
+        # input a block without computing the output (see conv())
 
         # shifted into buffer
+        # (row by row, since numpy copies the overlapping 2-dim slices)
         len_in = x.shape[-1]
-        self.in_buf[:, 0, :self.N] = self.in_buf[:, 0, self.N:]
-        self.in_buf[:, 0, self.N:self.N + len_in] = x
-        self.in_buf[:, 0, self.N + len_in:] = 0
+        for row in self.in_buf:
+            row[:self.N] = row[self.N:]
+        self.in_buf[:, self.N:self.N + len_in] = x
+        self.in_buf[:, self.N + len_in:] = 0
 
-        # convolution
-        in_f = np.fft.rfft(self.in_buf).transpose(2, 0, 1)
-        self.out_f[:] = 0
-        for c_ in self.c:
-            self.out_f[:] += c_.conv(in_f)
-        out = np.fft.irfft(self.out_f)[:, :self.N]
+        # newest spectrum into delay line
+        self.i_fdl = (self.i_fdl - 1) % self.len_fdl
+        in_f = self.fft.rfft(self.in_buf).T
+        self.fdl[:, self.i_fdl] = in_f
+        self.fdl[:, self.i_fdl + self.len_fdl] = in_f
 
         # buffering length
         if len_in != 0:
@@ -157,42 +228,542 @@ class OverlapSaveMIMO:
         else:
             self.len_buf -= self.N
 
-        return out, self.len_buf
+    def _mac(self):
+        # multiply-accumulate over all partitions, and inverse transform
+        j = self.i_fdl + self.delay
+        x_f = self.fdl[:, j:j + self.P].reshape(self.N + 1, -1)
+        if self.threads == 1:
+            self._mac_band(x_f, self.bands[0])
+        else:
+            # the first band in this thread, and the rest in the pool
+            jobs = [self.pool.submit(self._mac_band, x_f, f)
+                                                for f in self.bands[1:]]
+            self._mac_band(x_f, self.bands[0])
+            for job in jobs:
+                job.result()
+        out_f = self.out_f[:, :, 0].T
+        self.out[:] = self.fft.irfft(out_f, 2 * self.N)[:, :self.N]
+
+    def _mac_band(self, x_f, f):
+        # MAC of the frequency bins f (slice)
+        if self.sparse is None:
+            np.matmul(self.fir_f[f], x_f[f, :, None], out=self.out_f[f])
+        else:
+            self.sparse.mac(x_f, self.out_f, f)
             
     
     def clear_buffer(self):
-        for c_ in self.c:
-            c_.out_f_buf[:] = 0
+        self.in_buf[:] = 0
+        self.fdl[:] = 0
+
+    def get_spectra(self):
+        if self.sparse is None:
+            return [self.fir_f]
+        ch_out = self.out_f.shape[1]
+        ch_in = self.fdl.shape[2]
+        return [self.sparse.dense(self.N + 1, ch_out, self.P * ch_in)]
+
+    def _sparse(self):
+        # Sparse routing
+        #
+        # Sub-filters (columns of fir_f for each output channel) that are
+        # all zero are skipped by one of the following, whichever is
+        # cheaper. The dense fir_f is released in that case.
+        #
+        #   _Compact: matmul with only the output channels and columns
+        #             that are non-zero for any output channel
+        #   _Flat:    products of only the non-zero sub-filters, summed
+        #             up for each output channel (costs about SPARSE_COST
+        #             times per sub-filter as matmul does)
+        #
+        # return: None (dense), _Compact or _Flat
+
+        nonzero = np.any(self.fir_f != 0, axis=0) # [ch_out, P * ch_in]
+        rows = np.flatnonzero(nonzero.any(axis=1))
+        cols = np.flatnonzero(nonzero.any(axis=0))
+
+        cost_dense = nonzero.size
+        cost_compact = rows.size * cols.size
+        cost_flat = SPARSE_COST * nonzero.sum()
+        
+        if cost_dense <= min(cost_compact, cost_flat):
+            return None
+        elif cost_compact <= cost_flat:
+            sparse = _Compact(rows, cols, self.fir_f)
+        else:
+            sparse = _Flat(nonzero, self.fir_f)
+        self.fir_f = None
+        return sparse
+
+    def _transform(self, fir):
+        # split FIR and transform (zero-padded to 2N)
+        # return: [freq, ch_out, partition * ch_in]
+        N = self.N
+        ch_out = fir.shape[0]
+        ch_in = fir.shape[1]
+        fir_f = np.empty([N + 1, ch_out, self.P, ch_in], dtype=self.cdtype)
+        fir_zeropad = np.zeros([ch_out, ch_in, 2 * N])
+        for i in range(self.P):
+            fir_i = fir[:, :, i * N:(i + 1) * N]
+            fir_zeropad[:, :, N:N + fir_i.shape[-1]] = fir_i
+            fir_zeropad[:, :, N + fir_i.shape[-1]:] = 0
+            fir_f[:, :, i] = self.fft.rfft(fir_zeropad).transpose(2, 0, 1)
+        return fir_f.reshape(N + 1, ch_out, self.P * ch_in)
+
+
+class _Compact:
+    # MAC of OverlapSaveMIMO with non-zero rows and columns of fir_f
+
+    def __init__(self, rows, cols, fir_f):
+        self.rows = rows # output channels
+        self.cols = cols # indices of (partition, ch_in)
+        self.fir_f = fir_f[:, rows[:, None], cols] # [freq, rows, cols]
+        n_freq = fir_f.shape[0]
+        self.x_f = np.empty([n_freq, cols.size], dtype=fir_f.dtype)
+        self.out_f = np.empty([n_freq, rows.size, 1], dtype=fir_f.dtype)
+
+    def mac(self, x_f, out_f, f=slice(None)):
+        # (f: frequency bins)
+        np.take(x_f[f], self.cols, axis=1, out=self.x_f[f], mode='clip')
+        np.matmul(self.fir_f[f], self.x_f[f, :, None], out=self.out_f[f])
+        out_f[f, self.rows] = self.out_f[f]
+
+    def dense(self, n_freq, ch_out, n_col):
+        fir_f = np.zeros([n_freq, ch_out, n_col], dtype=self.fir_f.dtype)
+        fir_f[:, self.rows[:, None], self.cols] = self.fir_f
+        return fir_f
+
+
+class _Flat:
+    # MAC of OverlapSaveMIMO with non-zero sub-filters only
+
+    def __init__(self, nonzero, fir_f):
+        self.r, self.c = np.nonzero(nonzero) # sorted by output channel
+        self.rows, self.starts = np.unique(self.r, return_index=True)
+        self.fir_f = fir_f[:, self.r, self.c] # [freq, sub-filters]
+        n_freq = fir_f.shape[0]
+        self.prod = np.empty([n_freq, self.r.size], dtype=fir_f.dtype)
+        self.out_f = np.empty([n_freq, self.rows.size], dtype=fir_f.dtype)
+
+    def mac(self, x_f, out_f, f=slice(None)):
+        # (f: frequency bins)
+        prod = self.prod[f]
+        np.take(x_f[f], self.c, axis=1, out=prod, mode='clip')
+        np.multiply(self.fir_f[f], prod, out=prod)
+        np.add.reduceat(prod, self.starts, axis=1, out=self.out_f[f])
+        out_f[f, self.rows, 0] = self.out_f[f]
+
+    def dense(self, n_freq, ch_out, n_col):
+        fir_f = np.zeros([n_freq, ch_out, n_col], dtype=self.fir_f.dtype)
+        fir_f[:, self.r, self.c] = self.fir_f
+        return fir_f
+
+
+
+
+class OverlapAdd:
+    # Single partition convolver for offline rendering (export)
+    #
+    # The whole FIR is transformed with one FFT of n_fft >= L + len_fir - 1
+    # points, and each block of L samples is convolved at once. With L >=
+    # the length of the source, this is a single FFT convolution.
+    # The output is the same as OverlapSave/OverlapSaveMIMO (conv() returns
+    # L samples and the buffering length), but the FFT size is chosen
+    # from all sizes with small prime factors.
+    #
+    # fir: [len_fir] for each of `channel` channels, or
+    #      [ch_out, ch_in, len_fir] (channel is not used)
+    #
+    # Convolvers with the same L, n_fft and input channels can share the
+    # input spectrum: x_f = transform(x) of one, and conv_f(x_f, len_in)
+    # of each.
+
+    def __init__(self, fir, L, channel=1, dtype=np.float64, fft=None,
+                                                n_fft=None, spectra=None):
+        self.L = L
+        self.len_fir = fir.shape[-1]
+        self.dtype = dtype
+        self.cdtype = np.result_type(dtype, np.complex64)
+        self.fft = fft if fft is not None else fftbackend.get()
+        if n_fft is None:
+            n_fft = fftbackend.next_fast_len(L + self.len_fir - 1)
+        self.n_fft = n_fft
+
+        if fir.ndim == 1:
+            self.ch_in = self.ch_out = channel
+        else:
+            self.ch_out, self.ch_in = fir.shape[0], fir.shape[1]
+        n_freq = self.n_fft // 2 + 1
 
+        # FIR spectra [F] or [ch_out, ch_in, F]
+        # The spectra can be given, e.g. from SpectrumPool.
+        if spectra is None:
+            self.fir_f = self._transform(fir)
+        else:
+            self.fir_f = spectra[0]
+
+        # buffers
+        self.in_buf = np.zeros([self.ch_in, self.n_fft], dtype=dtype)
+        self.out_f = np.zeros([self.ch_out, n_freq], dtype=self.cdtype)
+        if fir.ndim == 3:
+            self.prod = np.zeros([self.ch_out, n_freq], dtype=self.cdtype)
+        self.acc = np.zeros([self.ch_out, self.n_fft], dtype=dtype)
+        self.out = np.zeros([self.ch_out, L], dtype=dtype)
+
+        # buffering length
+        self.len_buf = L
+
+    def conv(self, x):
+        # x: [ch_in, len_in] (len_in <= L)
+        len_in = x.shape[1]
+        x_f = self.transform(x) if len_in != 0 else None
+        return self.conv_f(x_f, len_in)
+
+    def transform(self, x):
+        # spectrum of a block x: [ch_in, len_in]
+        self.in_buf[:, :x.shape[1]] = x
+        self.in_buf[:, x.shape[1]:] = 0
+        return self.fft.rfft(self.in_buf)
+
+    def conv_f(self, x_f, len_in):
+        # convolution of a block from its spectrum (see transform())
+        if len_in != 0:
+            if self.fir_f.ndim == 1:
+                np.multiply(x_f, self.fir_f, out=self.out_f)
+            else:
+                self.out_f[:] = 0
+                for i in range(self.ch_in):
+                    np.multiply(self.fir_f[:, i], x_f[i], out=self.prod)
+                    self.out_f += self.prod
+            self.acc += self.fft.irfft(self.out_f, self.n_fft)
+
+        # overlap-add
+        self.out[:] = self.acc[:, :self.L]
+        self.acc[:, :-self.L] = self.acc[:, self.L:]
+        self.acc[:, -self.L:] = 0
+
+        # buffering length
+        if len_in != 0:
+            self.len_buf = self.len_fir + len_in - 1
+        else:
+            self.len_buf -= self.L
 
-class _ConvolverMIMO:
+        return self.out, self.len_buf
 
-    def __init__(self, fir, N, schedule):
+    def clear_buffer(self):
+        self.acc[:] = 0
+
+    def get_spectra(self):
+        return [self.fir_f]
+
+    def _transform(self, fir):
+        # (row by row)
+        n_freq = self.n_fft // 2 + 1
+        fir_2d = fir.reshape(-1, self.len_fir)
+        fir_f = np.empty([fir_2d.shape[0], n_freq], dtype=self.cdtype)
+        buf = np.zeros([1, self.n_fft], dtype=self.dtype)
+        for row in range(fir_2d.shape[0]):
+            buf[0, :self.len_fir] = fir_2d[row]
+            fir_f[row] = self.fft.rfft(buf)[0]
+        return fir_f.reshape(fir.shape[:-1] + (n_freq,))
+
+
+def overlap_add_mem(fir_shapes, channel, L, dtype):
+    # memory of OverlapAdd of block size L (bytes): the spectra and
+    # buffers of OverlapAdd, and the blocks of the caller
+    #
+    # fir_shapes: the shapes of FIRs applied to the same source
+    #             (sharing the input spectrum)
+
+    len_fir = max(shape[-1] for shape in fir_shapes)
+    n_fir, ch_in, ch_out = 0, channel, 0
+    for shape in fir_shapes:
+        if len(shape) == 1:
+            n_fir += 1
+            ch_out += channel
+        else:
+            n_fir += shape[0] * shape[1]
+            ch_out += shape[0]
+    r = np.dtype(dtype).itemsize
+    c = np.dtype(np.result_type(dtype, np.complex64)).itemsize
+
+    n = fftbackend.next_fast_len(L + len_fir - 1)
+    return ((n // 2 + 1) * c * (n_fir + ch_in + 2 * ch_out)
+            + n * r * (ch_in + ch_out) + 4 * L * r * (ch_in + ch_out))
+
+
+def overlap_add_block(fir_shapes, channel, len_src, dtype, mem_limit):
+    # block size L of OverlapAdd within mem_limit bytes (None: not fit)
+    #
+    # The whole source (single FFT) if it fits, otherwise the FFT size
+    # (power of 2) with the least operations per sample,
+    # n log n / (n - len_fir + 1), within the limit.
+
+    len_fir = max(shape[-1] for shape in fir_shapes)
+
+    def mem(L):
+        return overlap_add_mem(fir_shapes, channel, L, dtype)
+
+    L = max(len_src, 1)
+    if mem(L) <= mem_limit:
+        return L
+
+    best = None
+    n = 2 ** int(np.ceil(np.log2(2 * len_fir)))
+    while n - len_fir + 1 < len_src and mem(n - len_fir + 1) <= mem_limit:
+        cost = n * np.log2(n) / (n - len_fir + 1)
+        if best is None or cost < best[0]:
+            best = (cost, n - len_fir + 1)
+        n *= 2
+    return None if best is None else best[1]
+
+
+
+_pools = {}
+
+def _pool(threads):
+    # shared thread pool of OverlapSaveMIMO
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(threads)
+    return _pools[threads]
+
+
+def trim_length(fir, threshold_db):
+    # length of FIR without negligible tail
+    #
+    # The tail after the returned length has the energy (sum over all
+    # channels) below threshold_db relative to the total energy.
+    # fir can be a memory-mapped array (read in blocks).
+
+    len_fir = fir.shape[-1]
+    energy = np.zeros(len_fir)
+    for ss in range(0, len_fir, 65536):
+        block = np.asarray(fir[..., ss:ss + 65536], dtype=np.float64)
+        energy[ss:ss + 65536] = (block ** 2).reshape(-1, block.shape[-1]).sum(0)
+
+    tail = np.cumsum(energy[::-1])[::-1] # energy from each sample to the end
+    if tail[0] == 0:
+        return 1
+    return max(np.count_nonzero(tail > tail[0] * 10 ** (threshold_db / 10)), 1)
+
+
+def tail_l1(fir, N):
+    # sum of |fir| from each block boundary to the end
+    #
+    # return: [..., P + 1] (P = ceil(len_fir / N)), the last is 0.
+    # The output after the input ends is bounded with this:
+    # |y[n]| <= max|x| * tail_l1[floor((n - len_in + 1) / N)]
+
+    P = int(np.ceil(fir.shape[-1] / N))
+    block_l1 = np.zeros(fir.shape[:-1] + (P + 1,))
+    for b in range(P):
+        block_l1[..., b] = np.abs(fir[..., b * N:(b + 1) * N]).sum(-1)
+    return np.cumsum(block_l1[..., ::-1], axis=-1)[..., ::-1]
+
+
+
+def partition_layout(len_fir, N, max_partition, n_min=2):
+    # Non-uniform partitioning of FIR
+    #
+    # The FIR is split into partitions whose size starts at N and is
+    # doubled up to max_partition. A partition of size M can start only
+    # at a multiple of M (at least M) so that its result is ready in time.
+    # At least n_min partitions of each size are used.
+    #
+    # return: list of (size, start, stop) of the partition groups
+
+    layout = []
+    M = N
+    start = 0
+    count = 0
+    ss = 0
+    while ss < len_fir:
+        if 2 * M <= max_partition and count >= n_min and ss % (2 * M) == 0:
+            layout.append((M, start, ss))
+            M *= 2
+            start = ss
+            count = 0
+        ss += M
+        count += 1
+    layout.append((M, start, min(ss, len_fir)))
+    return layout
+
+
+class _NonUniform:
+    # Non-uniform partitioned overlap-save convolution
+    #
+    # The head of the FIR is convolved with N-point partitions,
+    # so the latency is the same as the uniform one with N.
+    # The tail is convolved with larger partitions (up to max_partition)
+    # at a lower rate, which reduces the cost per block for long FIR.
+    #
+    # Each partition group of size M > N is processed by an uniform
+    # convolver with block size M. Its input is collected N samples
+    # at a time, and its output is delayed by M and released N samples
+    # at a time.
+
+    def _setup(self, fir, N, max_partition, ch_in, ch_out, dtype, fft,
+                                                                spectra):
         self.N = N
-        self.schedule = schedule
+        self.dtype = dtype
+        self.fft = fft
+        self.len_fir = fir.shape[-1]
+        self.layout = partition_layout(self.len_fir, N, max_partition)
 
-        ch_out = fir.shape[0]
-        ch_in = fir.shape[1]
-        
-        # FIR (frequency domain)
-        fir_zeropad = np.zeros([ch_out, ch_in, 2 * N])
-        fir_zeropad[:, :, N:N + fir.shape[-1]] = fir
-        self.fir_f = np.fft.rfft(fir_zeropad).transpose(2, 0, 1)
-        
-        # output buffer delay output timing by N * schedule
-        self.out_f_buf = np.zeros([schedule + 1, ch_out, N + 1],
-                                                        dtype=np.complex)
-        self.i_buf = 0
-        
-    def conv(self, x_f):
-        # convolution
-        y_f = np.matmul(self.fir_f, x_f).transpose(1, 2, 0)
-        self.out_f_buf[self.i_buf] = y_f[:, 0, :]
-        # index ring buffer
-        self.i_buf += 1
-        if self.i_buf > self.schedule:
-            self.i_buf = 0
-        return self.out_f_buf[self.i_buf]
+        # spectra of each partition group (e.g. from SpectrumCache)
+        if spectra is None:
+            spectra = [None] * len(self.layout)
+        else:
+            spectra = [[fir_f] for fir_f in spectra]
+
+        # head (N-point partitions)
+        M, start, stop = self.layout[0]
+        self.head = self._convolver(fir[..., start:stop], M, 0, spectra[0])
+
+        # tail (larger partitions)
+        self.tail = []
+        for (M, start, stop), spectra_ in zip(self.layout[1:], spectra[1:]):
+            c_ = self._convolver(
+                    fir[..., start:stop], M, start // M - 1, spectra_)
+            self.tail.append(_Stage(c_, M, ch_in, ch_out, dtype))
+
+        # buffering length
+        self.len_buf = self.N
+
+        # the number of input blocks since clear_buffer() (see prime())
+        self.n_block = 0
+
+    def conv(self, x):
+
+        len_in = x.shape[-1]
+
+        # head
+        out, _ = self.head.conv(x)
+
+        # tail
+        for s in self.tail:
+            s.in_buf[:, s.pos:s.pos + len_in] = x
+            s.in_buf[:, s.pos + len_in:s.pos + self.N] = 0
+            for row, buf in zip(out, s.out_buf): # (no temporary copy)
+                row += buf[s.pos:s.pos + self.N]
+            s.pos += self.N
+            if s.pos == s.M:
+                s.out_buf[:], _ = s.c.conv(s.in_buf)
+                s.pos = 0
+        self.n_block += 1
+
+        # buffering length
+        if len_in != 0:
+            self.len_buf = self.len_fir + len_in - 1
+        else:
+            self.len_buf -= self.N
+
+        return out, self.len_buf
+
+    def clear_buffer(self):
+        self.head.clear_buffer()
+        for s in self.tail:
+            s.clear_buffer()
+        self.n_block = 0
+
+    def prime(self, blocks):
+        # input blocks (iterable of [ch_in, <= N]) without computing the
+        # output, so that the next conv() continues as if they had been
+        # convolved (e.g. the input history for a new FIR)
+        #
+        # A cleared convolver should start at a block of history() with
+        # n_block set to it, since the partition groups are aligned to
+        # the blocks from the last clear_buffer().
+
+        for x in blocks:
+            len_in = x.shape[-1]
+            self.head.push(x)
+            for s in self.tail:
+                s.in_buf[:, s.pos:s.pos + len_in] = x
+                s.in_buf[:, s.pos + len_in:s.pos + self.N] = 0
+                s.pos += self.N
+                if s.pos == s.M:
+                    s.c.push(s.in_buf)
+                    s.pos = 0
+            self.n_block += 1
+
+            # buffering length
+            if len_in != 0:
+                self.len_buf = self.len_fir + len_in - 1
+            else:
+                self.len_buf -= self.N
+
+        # output of the last block of each partition group
+        for s in self.tail:
+            s.c._mac()
+            s.out_buf[:] = s.c.out
+
+    def history(self, n):
+        # the first input block that the output after block n depends on
+        # (aligned to the largest partition, see prime())
+        R = self.layout[-1][0] // self.N
+        k = n - -(-self.len_fir // self.N) - 3 * R
+        return max(k - k % R, 0)
+
+    def get_spectra(self):
+        spectra = self.head.get_spectra()
+        for s in self.tail:
+            spectra += s.c.get_spectra()
+        return spectra
+
+
+class _Stage:
+
+    def __init__(self, c, M, ch_in, ch_out, dtype):
+        self.c = c
+        self.M = M
+        self.in_buf = np.zeros([ch_in, M], dtype=dtype)
+        self.out_buf = np.zeros([ch_out, M], dtype=dtype)
+        self.pos = 0
+
+    def clear_buffer(self):
+        self.c.clear_buffer()
+        self.in_buf[:] = 0
+        self.out_buf[:] = 0
+        self.pos = 0
+
+
+class NonUniformOverlapSave(_NonUniform):
+    # Non-uniform partitioned version of OverlapSave
+    #
+    # SISO FIR is applied in parallel to all channels.
+    # fir.ndim should be 1.
+
+    def __init__(self, fir, N, channel, max_partition, dtype=np.float64,
+                                                fft=None, spectra=None):
+        if fir.ndim != 1:
+            raise Exception('invalid fir shape')
+        self.channel = channel
+        self._setup(fir, N, max_partition, channel, channel, dtype, fft,
+                                                                spectra)
+
+    def _convolver(self, fir, M, delay, spectra):
+        return OverlapSave(fir, M, self.channel, delay, self.dtype,
+                                                        self.fft, spectra)
+
+
+class NonUniformOverlapSaveMIMO(_NonUniform):
+    # Non-uniform partitioned version of OverlapSaveMIMO
+    #
+    # MIMO FIR is applied.
+    # fir.ndim should be 3.
+
+    def __init__(self, fir, N, max_partition, dtype=np.float64,
+                                    fft=None, spectra=None, threads=1):
+        if fir.ndim != 3:
+            raise Exception('invalid fir shape')
+        self.threads = threads
+        self._setup(fir, N, max_partition, fir.shape[1], fir.shape[0],
+                                                    dtype, fft, spectra)
+
+    def _convolver(self, fir, M, delay, spectra):
+        return OverlapSaveMIMO(fir, M, delay, self.dtype, self.fft, spectra,
+                                                                self.threads)
 
 
 
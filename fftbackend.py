@@ -0,0 +1,177 @@
+import os
+import numpy as np
+
+try:
+    import scipy.fft
+except ImportError:
+    scipy = None
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+
+# backend used by get() with name='auto'
+# 'auto' chooses pyFFTW, scipy.fft, NumPy in this order (if installed)
+BACKEND = 'auto'
+
+# the largest transform planned with FFTW_MEASURE (points)
+# Measuring takes seconds for larger ones, which are planned with
+# FFTW_ESTIMATE (e.g. the single FFT of export used only a few times).
+MEASURE_MAX = 2 ** 16
+
+
+
+class NumpyFFT:
+    # np.fft
+    # Single thread, and planned on every call.
+
+    name = 'numpy'
+
+    def __init__(self, workers=1):
+        self.workers = 1
+
+    def rfft(self, x):
+        return np.fft.rfft(x)
+
+    def irfft(self, x_f, n):
+        return np.fft.irfft(x_f, n)
+
+    def __repr__(self):
+        return 'NumpyFFT()'
+
+
+class ScipyFFT:
+    # scipy.fft (pocketfft)
+    # Plans are cached inside scipy.fft.
+    # Transforms of multiple channels are distributed over workers.
+    # Single precision input is transformed in single precision.
+
+    name = 'scipy'
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+    def rfft(self, x):
+        return scipy.fft.rfft(x, workers=self.workers)
+
+    def irfft(self, x_f, n):
+        return scipy.fft.irfft(x_f, n, workers=self.workers)
+
+    def __repr__(self):
+        return 'ScipyFFT(workers=%d)' % self.workers
+
+
+class FFTWFFT:
+    # pyFFTW
+    # A plan is made for each (shape, dtype), i.e. for each
+    # (N, channels, dtype), and cached (see also MEASURE_MAX).
+    #
+    # The returned array is the output buffer of the plan,
+    # which is overwritten by the next call of the same plan.
+    # Copy it if necessary.
+    # Plans are not thread-safe; use one instance per thread.
+
+    name = 'pyfftw'
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.plans = {}
+
+    def rfft(self, x):
+        key = ('rfft', x.shape, x.dtype.str)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = pyfftw.builders.rfft(
+                    np.zeros(x.shape, dtype=x.dtype), threads=self.workers,
+                    planner_effort=self._effort(x.shape[-1]))
+            self.plans[key] = plan
+        return plan(x)
+
+    def irfft(self, x_f, n):
+        key = ('irfft', x_f.shape, x_f.dtype.str, n)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = pyfftw.builders.irfft(
+                    np.zeros(x_f.shape, dtype=x_f.dtype), n=n,
+                    threads=self.workers, planner_effort=self._effort(n))
+            self.plans[key] = plan
+        return plan(x_f)
+
+    def _effort(self, n):
+        return 'FFTW_MEASURE' if n <= MEASURE_MAX else 'FFTW_ESTIMATE'
+
+    def __repr__(self):
+        return 'FFTWFFT(workers=%d)' % self.workers
+
+
+
+def next_fast_len(n):
+    # smallest 2^a 3^b 5^c >= n (efficient size for all backends)
+    if scipy is not None:
+        return scipy.fft.next_fast_len(n, real=True)
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+
+_backends = {}
+
+def get(name=None, workers=1):
+    # return shared backend instance
+    #
+    # name: 'auto', 'pyfftw', 'scipy', 'numpy' (None: BACKEND)
+    # workers: the number of threads (-1: all cores)
+
+    name, workers = _resolve(name, workers)
+    key = (name, workers)
+    if key not in _backends:
+        _backends[key] = new(name, workers)
+    return _backends[key]
+
+
+def new(name=None, workers=1):
+    # return new backend instance (not shared, see get())
+    #
+    # For a convolver built in one thread while another thread is
+    # transforming with the shared instance (e.g. FIR swap while playing).
+
+    name, workers = _resolve(name, workers)
+    if name == 'pyfftw':
+        if pyfftw is None:
+            raise Exception('pyFFTW is not installed')
+        return FFTWFFT(workers)
+    elif name == 'scipy':
+        if scipy is None:
+            raise Exception('SciPy is not installed')
+        return ScipyFFT(workers)
+    elif name == 'numpy':
+        return NumpyFFT(workers)
+    else:
+        raise Exception('unknown FFT backend: %s' % name)
+
+
+def _resolve(name, workers):
+    if name is None:
+        name = BACKEND
+    if name == 'auto':
+        if pyfftw is not None:
+            name = 'pyfftw'
+        elif scipy is not None:
+            name = 'scipy'
+        else:
+            name = 'numpy'
+    if workers < 0:
+        workers = os.cpu_count() or 1
+    return name, workers
@@ -0,0 +1,148 @@
+import os
+import sys
+import hashlib
+import collections
+import numpy as np
+
+
+# cache directory and its size limit (bytes)
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+CACHE_SIZE = 4 * 1024 ** 3
+
+# size limit of SpectrumPool (bytes)
+POOL_SIZE = 1024 ** 3
+
+
+
+class SpectrumCache:
+    # Persistent cache of partitioned FIR spectra
+    #
+    # The spectra computed by a convolver (get_spectra()) are saved as
+    # a .npz file, and given to the next instantiation of the same
+    # convolver with the same FIR file, which skips reading and FFT of FIR.
+    #
+    # The file name is the hash of the FIR file (real path, size, mtime),
+    # the convolver class, the FIR shape and the convolver parameters
+    # (partition size, channels, dtype, ...).
+    # Modified FIR files get new keys, and old entries are evicted
+    # in LRU order when the total size exceeds max_bytes.
+
+    def __init__(self, cachedir=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+
+    def build(self, path2fir, cls, fir, *args, **kwargs):
+        # instantiate cls(fir, *args, **kwargs, spectra=...)
+        # (the FFT backend and the threads are not in the key, since they
+        # do not change the spectra)
+        params = sorted((k, v) for k, v in kwargs.items()
+                                        if k not in ('fft', 'threads'))
+        key = self.key(path2fir, cls.__name__, fir.shape, fir.dtype,
+                                                            args, params)
+        spectra = self.load(key)
+        c = cls(fir, *args, **kwargs, spectra=spectra)
+        if spectra is None:
+            self.save(key, c.get_spectra())
+        return c
+
+    def key(self, path2fir, *params):
+        st = os.stat(path2fir)
+        src = (os.path.realpath(path2fir), st.st_size, st.st_mtime_ns)
+        src += params
+        return hashlib.sha1(repr(src).encode()).hexdigest()
+
+    def load(self, key):
+        fname = self._fname(key)
+        try:
+            with np.load(fname) as npz:
+                spectra = [npz['arr_%d' % i] for i in range(len(npz.files))]
+            os.utime(fname) # mark as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        return spectra
+
+    def save(self, key, spectra):
+        size = sum(fir_f.nbytes for fir_f in spectra)
+        if size > self.max_bytes:
+            return
+
+        fname = self._fname(key)
+        tmp = '%s.%d.tmp' % (fname, os.getpid()) # (parallel export)
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                np.savez(f, *spectra)
+            os.replace(tmp, fname)
+            self.evict()
+        except OSError as e:
+            print('SpectrumCache:', e, file=sys.stderr)
+
+    def evict(self):
+        # remove least recently used files until size <= max_bytes
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.cachedir, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cachedir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.cachedir, name))
+
+    def _fname(self, key):
+        return os.path.join(self.cachedir, key + '.npz')
+
+
+
+class SpectrumPool:
+    # In-memory pool of FIR spectra (for an export run)
+    #
+    # The spectra are keyed by the caller (FIR file, FIR shape, FFT size,
+    # dtype, ...) and shared read-only by the convolvers of all tasks,
+    # each of which has its own delay line and buffers.
+    # The least recently used ones are dropped when the total exceeds
+    # max_bytes.
+
+    def __init__(self, max_bytes=POOL_SIZE):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+    def build(self, key, make):
+        # return make(spectra), a convolver with the pooled spectra of key
+        # (None if not pooled, then the spectra of it are pooled)
+        spectra = self.entries.get(key)
+        if spectra is not None:
+            self.entries.move_to_end(key)
+        c = make(spectra)
+        if spectra is None:
+            self.put(key, c.get_spectra())
+        return c
+
+    def put(self, key, spectra):
+        size = sum(fir_f.nbytes for fir_f in spectra)
+        if size > self.max_bytes:
+            return
+        for fir_f in spectra:
+            fir_f.flags.writeable = False
+        self.entries[key] = spectra
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= sum(fir_f.nbytes for fir_f in old)
+
+
+
+# shared by Player and batch export
+cache = SpectrumCache()
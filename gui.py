@@ -82,15 +82,28 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # FFT-point
         self.combo_fftpoint = QtWidgets.QComboBox()
-        N_list = ['nextpow2+%d' % i for i in range(1, 11)]
+        N_list = ['auto']
+        N_list += ['nextpow2+%d' % i for i in range(1, 11)]
         N_list += ['%d' % (2 ** i) for i in range(7, 20)]
         self.combo_fftpoint.addItems(N_list)
 
         # wave format
         self.combo_wavfmt = QtWidgets.QComboBox()
-        self.combo_wavfmt.addItems(['16 bit', '24 bit', '32 bit'])
+        self.combo_wavfmt.addItems(['16 bit', '24 bit', '32 bit',
+                                                        '32 bit float'])
         self.combo_wavfmt.setCurrentIndex(1)
 
+        # processing precision (for export)
+        self.combo_precision = QtWidgets.QComboBox()
+        self.combo_precision.addItems(['float64', 'float32'])
+
+        # FIR tail trimming (for export)
+        self.combo_trim = QtWidgets.QComboBox()
+        self.combo_trim.addItems(['full FIR', 'trim -140 dB',
+                                    'trim -120 dB', 'trim -100 dB'])
+        self.combo_trim.setToolTip(
+                'Trim the FIR tail whose energy is below the threshold')
+
         # export button        
         self.btn_export = QtWidgets.QPushButton('Export', self)
         self.btn_export.setMinimumSize(80, 30)
@@ -114,6 +127,8 @@ class MainWindow(QtWidgets.QMainWindow):
         box_row4.addWidget(self.line_dir)
         box_row4.addWidget(self.combo_fftpoint)
         box_row4.addWidget(self.combo_wavfmt)
+        box_row4.addWidget(self.combo_precision)
+        box_row4.addWidget(self.combo_trim)
         box_row4.addWidget(self.btn_export)
         
         central_box = QtWidgets.QVBoxLayout()
@@ -229,12 +244,17 @@ class MainWindow(QtWidgets.QMainWindow):
         
         
     def _play_row(self, row):
+        # same source while playing: swap FIR only (for A/B comparison)
+        data = self.playlistmodel.get_data(row)
+        if self.player.can_swap(data):
+            self._swap_row(row, data)
+            return
+
         self.label_pos.setText('0:00/0:00')
         self.slider_pos.setValue(0)
         self.slider_pos.setEnabled(False)
         self.playlistmodel.clear_playmark()
 
-        data = self.playlistmodel.get_data(row)
         print('play: row', row)
         print('source:', data['path2src'])
         print('FIR:', data['path2fir'])
@@ -247,18 +267,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.playlistmodel.set_errormark(row)
             return
 
-        # label
-        info = self.player.get_generator_info()
-        text = 'Source: %d ch, %d Hz, %s\n'\
-                % (info['ch_src'], info['fs'], data['disp_src'])
-
-        if info['mode'] == 'SISO':
-            text += 'FIR: single, %s' % data['disp_fir']
-        elif info['mode'] == 'MIMO':
-            shape = info['fir_shape']
-            text += 'FIR: %din/%dout, %s'\
-                    % (shape[1], shape[0], data['disp_fir'])
-        self.label_state.setText(text)
+        self._show_info(data)
 
         try:
             state = self.player.play()
@@ -281,6 +290,37 @@ class MainWindow(QtWidgets.QMainWindow):
             self.slider_pos.setEnabled(True)
         
 
+    def _swap_row(self, row, data):
+        print('swap: row', row)
+        print('FIR:', data['path2fir'])
+
+        try:
+            self.player.swap_fir(data)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            self.label_state.setText('FIR not swapped\n%s' % e)
+            self.playlistmodel.set_errormark(row)
+            return
+
+        self.playlistmodel.clear_playmark()
+        self.playlistmodel.set_playmark(row)
+        self._show_info(data)
+
+    def _show_info(self, data):
+        # label
+        info = self.player.get_generator_info()
+        text = 'Source: %d ch, %d Hz, %s\n'\
+                % (info['ch_src'], info['fs'], data['disp_src'])
+
+        if info['mode'] == 'SISO':
+            text += 'FIR: single, %s' % data['disp_fir']
+        elif info['mode'] == 'MIMO':
+            shape = info['fir_shape']
+            text += 'FIR: %din/%dout, %s'\
+                    % (shape[1], shape[0], data['disp_fir'])
+        self.label_state.setText(text)
+
+
     def stop(self):
         self.timer.stop()
         self.label_pos.setText('0:00/0:00')
@@ -486,12 +526,29 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # get sampwidth
         wavfmt = self.combo_wavfmt.currentText()
+        is_float = False
         if wavfmt == '24 bit':
             sampwidth = 3
         elif wavfmt == '16 bit':
             sampwidth = 2
         elif wavfmt == '32 bit':
             sampwidth = 4
+        elif wavfmt == '32 bit float':
+            sampwidth = 4
+            is_float = True
+
+        # get precision
+        if self.combo_precision.currentText() == 'float32':
+            dtype = np.float32
+        else:
+            dtype = np.float64
+
+        # get tail trimming threshold
+        trim = self.combo_trim.currentText()
+        if trim == 'full FIR':
+            trim_db = None
+        else:
+            trim_db = float(trim.split()[1])
 
         # tasks
         indexes_sel = self.playlistview.selectedIndexes()
@@ -509,7 +566,8 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # process
         error_log = batch.export(
-                tasks, export_path, sampwidth, fftpoint_str, progress)
+                tasks, export_path, sampwidth, fftpoint_str, progress,
+                dtype, trim_db, is_float=is_float)
 
         # close progressbar
         progress.reset()
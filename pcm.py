@@ -0,0 +1,179 @@
+import numpy as np
+
+
+# PCM codec of WAV data (little-endian)
+#
+# decode: frames (bytes-like) -> out (float, [n_samples])
+# encode: data (float, [n_samples]) -> out (uint8, [n_samples * sampwidth])
+#
+# The results are written into the buffers given by the caller, and the
+# filled part of out is returned (a view). 24-bit needs an int32
+# scratch buffer of n_samples (allocated if None).
+# frames can be a view of the file (see wavfile.WavReader), and it is
+# read in place. encode clips data in place (integer formats).
+#
+# Integer samples are scaled by 1 / 2^(bits - 1), and the output is
+# clipped to [-1, 1 - 1 LSB] and truncated toward zero.
+#
+# Each pass is a cast assignment or an in-place operation of the same
+# dtype, so that no temporary arrays are made (ufuncs with a cast or an
+# unaligned input allocate their buffers on every call), e.g. in the
+# audio callback. The buffers of a block stay in the cache over the
+# passes.
+
+
+
+class Decoder:
+    # decode function with its own buffers (grown as needed)
+    # The returned array is overwritten by the next call.
+
+    def __init__(self, sampwidth, dtype=np.float64, is_float=False):
+        self.decode = decoder(sampwidth, is_float)
+        self.sampwidth = sampwidth
+        self.out = np.zeros(0, dtype=dtype)
+        self.scratch = np.zeros(0, dtype='<i4')
+
+    def __call__(self, frames):
+        n = len(frames) // self.sampwidth
+        if self.out.shape[0] < n:
+            self.out = np.zeros(n, dtype=self.out.dtype)
+            if self.sampwidth == 3:
+                self.scratch = np.zeros(n, dtype='<i4')
+        return self.decode(frames, self.out, self.scratch)
+
+
+class Encoder:
+    # encode function with its own buffers (grown as needed)
+    # The returned array is overwritten by the next call.
+
+    def __init__(self, sampwidth, is_float=False):
+        self.encode = encoder(sampwidth, is_float)
+        self.sampwidth = sampwidth
+        self.out = np.zeros(0, dtype=np.uint8)
+        self.scratch = np.zeros(0, dtype='<i4')
+
+    def __call__(self, data):
+        n = data.shape[0]
+        if self.out.shape[0] < n * self.sampwidth:
+            self.out = np.zeros(n * self.sampwidth, dtype=np.uint8)
+            if self.sampwidth == 3:
+                self.scratch = np.zeros(n, dtype='<i4')
+        return self.encode(data, self.out, self.scratch)
+
+
+
+def decoder(sampwidth, is_float=False):
+    # decode function of the format
+    if is_float and sampwidth == 4:
+        return decode_float32
+    elif is_float:
+        raise Exception('Unsupported wave format')
+    elif sampwidth == 2:
+        return decode_16bit
+    elif sampwidth == 3:
+        return decode_24bit
+    elif sampwidth == 4:
+        return decode_32bit
+    else:
+        raise Exception('Unsupported wave format')
+
+
+def encoder(sampwidth, is_float=False):
+    # encode function of the format
+    if is_float and sampwidth == 4:
+        return encode_float32
+    elif is_float:
+        raise Exception('Unsupported wave format')
+    elif sampwidth == 2:
+        return encode_16bit
+    elif sampwidth == 3:
+        return encode_24bit
+    elif sampwidth == 4:
+        return encode_32bit
+    else:
+        raise Exception('Unsupported wave format')
+
+
+
+def decode_16bit(frames, out, scratch=None):
+    a16 = np.frombuffer(frames, dtype='<i2')
+    out = out[:a16.shape[0]]
+    out[:] = a16
+    out *= 1 / 32768
+    return out
+
+
+def decode_24bit(frames, out, scratch=None):
+    # The sample i is the upper 3 bytes of the int32 at byte 3i - 1
+    # (overlapping strided view, the lowest byte is the last byte of
+    # the previous sample), which is copied into scratch and masked.
+    a8 = np.frombuffer(frames, dtype=np.uint8)
+    n = a8.shape[0] // 3
+    out = out[:n]
+    if n == 0:
+        return out
+    if scratch is None:
+        scratch = np.empty(n, dtype='<i4')
+    a32 = scratch[:n]
+
+    a32[0] = int.from_bytes(a8[:3].tobytes(), 'little', signed=True) << 8
+    if n > 1:
+        a32[1:] = np.ndarray((n - 1,), dtype='<i4', buffer=a8[:3 * n],
+                                                    offset=2, strides=(3,))
+        a32[1:] &= -256
+    out[:] = a32
+    out *= 1 / 2147483648
+    return out
+
+
+def decode_32bit(frames, out, scratch=None):
+    a32 = np.frombuffer(frames, dtype='<i4')
+    out = out[:a32.shape[0]]
+    out[:] = a32
+    out *= 1 / 2147483648
+    return out
+
+
+def decode_float32(frames, out, scratch=None):
+    f32 = np.frombuffer(frames, dtype='<f4')
+    out = out[:f32.shape[0]]
+    out[:] = f32
+    return out
+
+
+
+def encode_16bit(data, out, scratch=None):
+    # (clipping before scaling by a power of 2 is exact)
+    np.clip(data, -1, 32767 / 32768, out=data)
+    data *= 32768
+    out[:2 * data.shape[0]].view('<i2')[:] = data
+    return out[:2 * data.shape[0]]
+
+
+def encode_24bit(data, out, scratch=None):
+    # scaled into scratch, and its lower 3 bytes are copied
+    n = data.shape[0]
+    if scratch is None:
+        scratch = np.empty(n, dtype='<i4')
+    a32 = scratch[:n]
+    np.clip(data, -1, 8388607 / 8388608, out=data)
+    data *= 8388608
+    a32[:] = data
+    a8 = out[:3 * n]
+    a8.reshape(n, 3)[:] = a32.view(np.uint8).reshape(n, 4)[:, :3]
+    return a8
+
+
+def encode_32bit(data, out, scratch=None):
+    # (the largest value below 2^31, 2147483647 is not exact in float32)
+    upper = np.nextafter(data.dtype.type(2147483648), data.dtype.type(0))
+    np.clip(data, -1, upper / 2147483648, out=data)
+    data *= 2147483648
+    out[:4 * data.shape[0]].view('<i4')[:] = data
+    return out[:4 * data.shape[0]]
+
+
+def encode_float32(data, out, scratch=None):
+    # (not clipped)
+    out[:4 * data.shape[0]].view('<f4')[:] = data
+    return out[:4 * data.shape[0]]
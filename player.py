@@ -1,9 +1,16 @@
 import pyaudio
-import wave
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 from PyQt5 import QtCore
 
-from convolution import OverlapSave, OverlapSaveMIMO
+from convolution import NonUniformOverlapSave, NonUniformOverlapSaveMIMO
+from convolution import trim_length
+import wavfile
+import pcm
+import fircache
+import fftbackend
 
 
 class Player(QtCore.QObject):
@@ -19,7 +26,35 @@ class Player(QtCore.QObject):
     pausing = 3
 
     # the number of frames per buffer
-    CHUNK = 2048
+    CHUNK = 512
+
+    # the maximum partition size of the non-uniform convolver
+    # (CHUNK: uniform; the blocks computing the larger partitions are
+    # heavier, which LOOKAHEAD absorbs; see README "Convolution engine"
+    # and python benchmark.py partition)
+    MAX_PARTITION = 8192
+
+    # data type of processing
+    # (float32 is enough for playback, since the output is float32)
+    DTYPE = np.float32
+
+    # trim FIR tail below this energy relative to the total (dB)
+    # (None: no trimming)
+    TRIM_DB = None
+
+    # the number of blocks rendered ahead by a worker thread
+    # (0: render in the PortAudio callback)
+    LOOKAHEAD = 4
+
+    # render in a separate process (see ProcessGenerator)
+    PROCESS = False
+
+    # the number of threads of MIMO convolution
+    THREADS = 1
+
+    # the number of source frames read ahead by a worker thread
+    # (see Prefetcher, 0: read the file in the PortAudio callback)
+    PREFETCH = 65536
     
     #
     # ----- state -----
@@ -36,6 +71,7 @@ class Player(QtCore.QObject):
     # ----- function and state change -----
     #
     # set_file(): empty/ready*1/playing*2 -> ready
+    # swap_fir(): playing/pausing -> (no change)
     #     play(): ready/playing*3 -> playing
     #     stop(): playing/pausing -> ready
     #    clear(): ready/playing/pausing -> empty
@@ -98,17 +134,40 @@ class Player(QtCore.QObject):
         elif config['path2fir'] == '':
             # play wave file direct
             generator = WavGenerator(
-                    config, self.stream_ended, self.peak_updated)
+                    config, self.stream_ended, self.peak_updated, self.DTYPE,
+                    self.PREFETCH)
         
+        elif self.PROCESS:
+            generator = ProcessGenerator(
+                    config, self.stream_ended, self.peak_updated,
+                    self.CHUNK, self.MAX_PARTITION, self.DTYPE, self.TRIM_DB,
+                    max(self.LOOKAHEAD, 1), self.THREADS, self.PREFETCH)
+
         else:
             generator = ConvGenerator(
-                    config, self.stream_ended, self.peak_updated, self.CHUNK)
+                    config, self.stream_ended, self.peak_updated,
+                    self.CHUNK, self.MAX_PARTITION, self.DTYPE, self.TRIM_DB,
+                    self.LOOKAHEAD, self.THREADS, self.PREFETCH)
 
         self.config = config
         self.generator = generator
         self.state = self.ready
         return self.state
 
+    def can_swap(self, config):
+        # True if FIR of the playing source can be replaced by swap_fir()
+        return (self.actually_playing()
+                and isinstance(self.generator,
+                                        (ConvGenerator, ProcessGenerator))
+                and config['path2src'] == self.config['path2src']
+                and config['path2fir'] != '')
+
+    def swap_fir(self, config):
+        # replace FIR without stopping the stream (see can_swap())
+        self.generator.swap_fir(config)
+        self.config = config
+        return self.state
+
     def play(self):
         if self.state == self.playing or self.state == self.pausing:
             self.stop()
@@ -170,6 +229,7 @@ class Player(QtCore.QObject):
     def clear(self):
         self.stop()
         if self.state == Player.ready:
+            self.generator.close()
             del self.generator
             self.state = Player.empty
         return self.state
@@ -215,13 +275,15 @@ class Player(QtCore.QObject):
 
 class WavGenerator:
     
-    def __init__(self, config, stream_ended, peak_updated):
+    def __init__(self, config, stream_ended, peak_updated, dtype=np.float64,
+                                                                prefetch=0):
         self.mode = 'direct'
         self.config = config
+        self.dtype = dtype
         self.stream_ended = stream_ended # Qt Signal
         self.peak_updated = peak_updated # Qt Signal
 
-        self.wf = wave.open(config['path2src'], 'rb')
+        self.wf = wavfile.WavReader(config['path2src'])
 
         self.fs = self.wf.getframerate()
         self.ws = self.wf.getsampwidth()
@@ -231,32 +293,40 @@ class WavGenerator:
 
         self.bytes_per_frame_src = self.nchannels_src * self.ws
 
-        if self.ws == 2:
-            self.buffer2float = self.buffer2float_16bit
-        elif self.ws == 3:
-            self.buffer2float = self.buffer2float_24bit
-        elif self.ws == 4:
-            self.buffer2float = self.buffer2float_32bit
-        else:
-            raise Exception ('Unsupported wave format')
+        # frames -> float (the array is reused by the next call)
+        self.decode = pcm.decoder(self.ws, self.wf.is_float)
+        self.buffer2float = pcm.Decoder(self.ws, dtype, self.wf.is_float)
+
+        # source read ahead (None: read in the callback)
+        self._prefetch(prefetch)
                 
     def __del__(self):
-        if 'ws' in locals():
+        if hasattr(self, 'wf'):
             self.wf.close()
 
+    def _prefetch(self, prefetch):
+        # start Prefetcher of prefetch frames (0: none)
+        self.source = None
+        if prefetch > 0:
+            self.source = Prefetcher(self.wf, self.decode, self.dtype,
+                                                                    prefetch)
+            self.block = np.zeros(0, dtype=self.dtype)
+
+    def close(self):
+        # (after the read-ahead thread, which uses the file)
+        if self.source is not None:
+            self.source.close()
+        self.wf.close()
+
     def callback(self, in_data, frame_count, time_info, status):
-        if self.wf.tell() == self.nframes:
+        data = self._read_direct(frame_count)
+        if data is None:
             self.stream_ended.emit() # --------------------------> emit signal
             return b'', pyaudio.paComplete
         else:
-            # read frame
-            frames = self.wf.readframes(frame_count)
-            nlack = self.bytes_per_frame_src * frame_count - len(frames)
+            nlack = frame_count * self.nchannels_src - data.shape[0]
             if nlack != 0:
-                frames += b'\x00' * nlack
-            
-            # convert to numpy array
-            data = self.buffer2float(frames)
+                data = np.concatenate([data, np.zeros(nlack, self.dtype)])
 
             # gain                
             data *= self.config['gain_src']
@@ -269,89 +339,750 @@ class WavGenerator:
 
             return out_data, pyaudio.paContinue
 
+    def _read_direct(self, frame_count):
+        # decoded frame_count frames (fewer at the end, None after the end)
+        if self.source is None:
+            if self.wf.tell() == self.nframes:
+                return None
+            # read frame (view of the file), and convert to numpy array
+            return self.buffer2float(self.wf.readframes(frame_count))
+
+        n = frame_count * self.nchannels_src
+        if self.block.shape[0] < n:
+            self.block = np.zeros(n, dtype=self.dtype)
+        len_in = self.source.read(self.block, frame_count)
+        if len_in is None:
+            # not read ahead yet (silence)
+            self.block[:n] = 0
+            return self.block[:n]
+        elif len_in == 0:
+            return None
+        return self.block[:len_in * self.nchannels_src]
+
     def _detect_peak(self, data):
-        peak = np.max(np.abs(data))
+        # (max/min of the flattened view, without temporary arrays)
+        data = data.reshape(-1)
+        peak = max(data.max(), -data.min())
         if peak > self.config['peak']:
             self.config['peak'] = peak
             self.config['peak_db'] = 20 * np.log10(peak)
             self.peak_updated.emit()
         
     def set_pos(self, pos):
-        self.wf.setpos(pos)
+        if self.source is None:
+            self.wf.setpos(pos)
+        else:
+            self.source.seek(pos)
 
     def get_pos(self):
-        return self.wf.tell()
+        if self.source is None:
+            return self.wf.tell()
+        return self.source.pos
 
-    def buffer2float_16bit(self, frames):
-        return np.frombuffer(frames, dtype=np.int16) / 32768
 
-    def buffer2float_24bit(self, frames):
-        a8 = np.frombuffer(frames, dtype=np.uint8)
-        tmp = np.zeros((a8.shape[0] // 3, 4), dtype=np.uint8)
-        tmp[:, 1:] = a8.reshape(-1, 3)
-        return tmp.view(np.int32)[:, 0] / 2147483648
 
-    def buffer2float_32bit(self, frames):
-        return np.frombuffer(frames, dtype=np.int32) / 2147483648
+class ConvGenerator(WavGenerator):
+    
+    def __init__(self, config, stream_ended, peak_updated, chunksize,
+                max_partition, dtype=np.float64, trim_db=None, lookahead=0,
+                threads=1, prefetch=0):
+        super().__init__(config, stream_ended, peak_updated, dtype)
+        self.chunksize = chunksize
+        self.max_partition = max_partition
+        self.trim_db = trim_db
+        self.threads = threads
 
+        # set convolver
+        self.os, self.mode, self.nchannels_out, self.fir_shape \
+                                                    = self._load(config)
 
+        # FIR waiting for swap (convolver, config), see swap_fir()
+        # (the lock is held by the rendering thread while convolving)
+        self.next = None
+        self.lock = threading.Lock()
+
+        # crossfade gain of the new FIR over one block
+        self.fade_in = (np.arange(chunksize) + 0.5) / chunksize
+        self.fade_in = self.fade_in.astype(dtype)
+
+        # The callback works in the following preallocated buffers, so
+        # that it makes no new arrays in the steady state (except those
+        # of the FFT backend; none with pyFFTW).
+        #
+        #   data:   interleaved float [chunksize * ch_src], decoded from
+        #           the view of the file (see wavfile.WavReader)
+        #   x:      deinterleaved view of data [ch_src, chunksize]
+        #   out:    interleaved float32 [chunksize, ch_out], returned
+        #           to PyAudio as it is (bytes-like object)
+        self.pos = 0
+        self.start = 0 # position of the last seek (see _prime())
+
+        self.data = np.zeros(chunksize * self.nchannels_src, dtype=dtype)
+        self.x = self.data.reshape(-1, self.nchannels_src).T
+        self.a32 = np.zeros(chunksize * self.nchannels_src, dtype='<i4')
+        self.out = np.zeros([chunksize, self.nchannels_out],
+                                                        dtype=np.float32)
+
+        # source read ahead (started here, so that no thread is left
+        # when the FIR fails to load)
+        self._prefetch(prefetch)
+
+        # render-ahead (see _render_ahead())
+        #
+        # The worker thread renders blocks into the ring buffer, and the
+        # callback only copies them out. Each index is written by one
+        # thread only (n_write: worker, n_read: callback), so no lock is
+        # needed. set_pos() increments gen, and the blocks of older gen
+        # are dropped.
+        self.lookahead = lookahead
+        self.play_pos = 0
+        if lookahead > 0:
+            self.ring = np.zeros([lookahead, chunksize, self.nchannels_out],
+                                                        dtype=np.float32)
+            self.ring_end = np.zeros(lookahead, dtype=bool)
+            self.ring_gen = np.zeros(lookahead, dtype=np.int64)
+            self.ring_pos = np.zeros(lookahead, dtype=np.int64)
+            self.n_read = 0
+            self.n_write = 0
+            self.gen = 0
+            self.next_pos = 0
+            self.underrun = 0
+            self.wake = threading.Event()
+            self.running = True
+            self.thread = threading.Thread(target=self._render_ahead,
+                                                                daemon=True)
+            self.thread.start()
+
+    def _load(self, config):
+        # return (convolver, mode, nchannels_out, fir_shape)
 
-class ConvGenerator(WavGenerator):
-    
-    def __init__(self, config, stream_ended, peak_updated, chunksize):
-        super().__init__(config, stream_ended, peak_updated)
-        
         # try to import FIR filter
         fir = np.load(config['path2fir'], 'r')
-        self.fir_shape = fir.shape
+        fir_shape = fir.shape
+
+        # trim negligible tail
+        if self.trim_db is not None:
+            fir = fir[..., :trim_length(fir, self.trim_db)]
+
+        # FFT backend of this convolver (not the shared one, which the
+        # rendering thread may be using while swap_fir() builds another;
+        # pyFFTW plans are not thread-safe)
+        fft = fftbackend.new()
 
-        # set convolver
         if fir.ndim == 1:
-            self.os = OverlapSave(fir, chunksize, self.nchannels_src)
-            self.mode = 'SISO'
+            c = fircache.cache.build(
+                    config['path2fir'], NonUniformOverlapSave,
+                    fir, self.chunksize, self.nchannels_src,
+                    self.max_partition, dtype=self.dtype, fft=fft)
+            return c, 'SISO', self.nchannels_src, fir_shape
         elif fir.ndim == 3:
             if fir.shape[1] != self.nchannels_src:
                 msg = 'channel mismatch: source %d-out >> FIR %d-in'\
                                         % (self.nchannels_src, fir.shape[1])
                 raise Exception(msg)
 
-            self.os = OverlapSaveMIMO(fir, chunksize)
-            self.nchannels_out = fir.shape[0]
-            self.mode = 'MIMO'
+            c = fircache.cache.build(
+                    config['path2fir'], NonUniformOverlapSaveMIMO,
+                    fir, self.chunksize, self.max_partition, dtype=self.dtype,
+                    fft=fft, threads=self.threads)
+            return c, 'MIMO', fir.shape[0], fir_shape
         else:
             raise Exception('Invalid FIR shape')
+
+    def swap_fir(self, config):
+        # Replace FIR while playing.
+        # The new convolver is built here (caller's thread), and
+        # crossfaded in over one block by the next rendering (the blocks
+        # already rendered ahead are played first, see lookahead).
+        # The source and the number of output channels should be the same.
+        c, mode, nchannels_out, fir_shape = self._load(config)
+        if nchannels_out != self.nchannels_out:
+            msg = 'channel mismatch: output %d-ch >> new FIR %d-ch'\
+                                        % (self.nchannels_out, nchannels_out)
+            raise Exception(msg)
+
+        # input history of the new convolver (as long as the new FIR),
+        # read again from the source, and the blocks rendered meanwhile
+        # under lock, so that its output continues without transient
+        state = self._prime(c, None, 0)
+        with self.lock:
+            self._prime(c, *state)
+            self.mode = mode
+            self.fir_shape = fir_shape
+            self.next = (c, config)
+
+    def _prime(self, c, start, n):
+        # input the blocks convolved since the last seek into the new
+        # convolver c, which has the blocks up to n since the seek to
+        # start (None: none)
+        # return (start, n) up to the current block
+        #
+        # The blocks are read from the source file, and only those the
+        # output of c depends on (see convolution._NonUniform.history()).
+        if start != self.start:
+            start = self.start
+            n = 0
+            c.clear_buffer()
+        n_1 = self.os.n_block
+        k = c.history(n_1)
+        if k > n:
+            c.clear_buffer()
+            c.n_block = k
+        else:
+            k = n
+        c.prime(self._blocks(start, k, n_1))
+        return start, n_1
+
+    def _blocks(self, start, k_0, k_1):
+        # source blocks k_0 ... k_1 - 1 after start, with the source gain
+        # (the input of the convolver, see _render())
+        data = np.zeros(self.chunksize * self.nchannels_src, dtype=self.dtype)
+        x = data.reshape(-1, self.nchannels_src).T
+        a32 = np.zeros(data.shape[0], dtype='<i4')
+        for k in range(k_0, k_1):
+            frames = self.wf.frames(start + k * self.chunksize, self.chunksize)
+            len_in = len(frames) // self.bytes_per_frame_src
+            self.decode(frames, data, a32)
+            data[len_in * self.nchannels_src:] = 0
+            data *= self.config['gain_src']
+            yield x[:, :len_in]
     
+    def close(self):
+        # stop the worker threads
+        if self.lookahead > 0:
+            self.running = False
+            self.wake.set()
+            self.thread.join()
+        super().close()
+
     def callback(self, in_data, frame_count, time_info, status):
+        if self.lookahead == 0:
+            ended = self._render(self.out)
+            self.play_pos = self.pos
+        else:
+            ended = self._pop()
+
+        if ended:
+            self.stream_ended.emit() # emit signal
+            return b'', pyaudio.paComplete
         
+        # output
+        return self.out, pyaudio.paContinue
+
+    def _pop(self):
+        # copy the oldest block in the ring buffer to self.out
+        # return True if the stream has ended
+        # drop the blocks rendered before set_pos() (only those, the
+        # following ones are at the new position)
+        n_read = self.n_read
+        while (self.n_read != self.n_write
+                and self.ring_gen[self.n_read % self.lookahead] != self.gen):
+            self.n_read += 1
+        if self.n_read == self.n_write:
+            if self.n_read == n_read:
+                self.underrun += 1
+            self.wake.set()
+            self.out[:] = 0
+            return False
+
+        i = self.n_read % self.lookahead
+        self.out[:] = self.ring[i]
+        self.play_pos = self.ring_pos[i]
+        ended = self.ring_end[i]
+        self.n_read += 1
+        self.wake.set()
+        return ended
+
+    def _render_ahead(self):
+        # worker thread
+        gen = self.gen
+        while self.running:
+            self.wake.clear()
+            if self.n_write - self.n_read >= self.lookahead:
+                self.wake.wait()
+                continue
+
+            if gen != self.gen:
+                gen = self.gen
+                self._seek(self.next_pos)
+
+            if not self.ready():
+                self.source.wait(self.chunksize / self.fs)
+                continue
+
+            i = self.n_write % self.lookahead
+            self.ring_end[i] = self._render(self.ring[i])
+            self.ring_gen[i] = gen
+            self.ring_pos[i] = self.pos
+            self.n_write += 1
+
+    def _render(self, out):
+        # render a block into out [chunksize, ch_out] (float32)
+        # return True if the stream has ended
+
         # read frames from source, and convert to float
-        frames = self.wf.readframes(frame_count)
-        data_in = self.buffer2float(frames)
+        len_in = self._read()
+        if len_in is None:
+            # not read ahead yet (silence, see Prefetcher)
+            out[:] = 0
+            return False
+        data_in = self.x[:, :len_in]
         
         # gain (source)
         data_in *= self.config['gain_src']
         
         # convolution
-        data_in = data_in.reshape([self.nchannels_src, -1], order='F')
-        data_out, len_buf = self.os.conv(data_in)
-        data_out = data_out.astype(np.float32)
-        
+        # (under lock, see swap_fir())
+        with self.lock:
+            next, self.next = self.next, None
+            if next is None:
+                data_out, len_buf = self.os.conv(data_in)
+                gain = self.config['gain_fir']
+            else:
+                data_out = self._crossfade(data_in, *next)
+                len_buf = self.os.len_buf
+                gain = 1
+
         if len_buf < 0:
+            return True
+
+        # gain (FIR), and interleave to float32
+        out[:] = data_out.T
+        out *= gain
+
+        # peak
+        self._detect_peak(out)
+        return False
+
+    def ready(self):
+        # True if the next block can be read without waiting for the disk
+        return self.source is None or self.source.ready(self.chunksize)
+
+    def _read(self):
+        # read a block into self.data, and return the number of frames
+        # (None: not read ahead yet)
+        if self.source is not None:
+            len_in = self.source.read(self.data, self.chunksize)
+            if len_in is not None:
+                self.data[len_in * self.nchannels_src:] = 0
+                self.pos = self.source.pos
+            return len_in
+
+        frames = self.wf.frames(self.pos, self.chunksize)
+        len_in = len(frames) // self.bytes_per_frame_src
+        n = len_in * self.nchannels_src
+        self.decode(frames, self.data, self.a32)
+        self.data[n:] = 0
+        self.pos += len_in
+        return len_in
+
+    def _crossfade(self, data_in, c, config):
+        # convolve a block with both FIRs, and switch to the new one
+        old, _ = self.os.conv(data_in)
+        old = old * self.config['gain_fir']
+        new, _ = c.conv(data_in)
+        new = new * config['gain_fir']
+        data_out = old + (new - old) * self.fade_in
+
+        self.os = c
+        self.config = config
+        return data_out
+
+    def set_pos(self, pos):
+        if self.lookahead == 0:
+            self._seek(pos)
+            self.play_pos = pos
+        else:
+            # the worker seeks and drops the blocks rendered ahead
+            self.next_pos = pos
+            self.play_pos = pos
+            self.gen += 1
+            self.wake.set()
+
+    def _seek(self, pos):
+        with self.lock:
+            self.os.clear_buffer()
+            self.start = pos
+        self.pos = pos
+        if self.source is not None:
+            self.source.seek(pos)
+
+    def get_pos(self):
+        return self.play_pos
+
+
+
+
+class ProcessGenerator:
+    # ConvGenerator in a separate process
+    #
+    # The worker process (_render_process()) owns a ConvGenerator, and
+    # renders blocks with unity gain into a ring buffer in shared memory
+    # (see _ring()), in the same way as ConvGenerator with lookahead.
+    # The callback in this process only copies a block out with the
+    # gains of config (so gain changes apply immediately) and detects
+    # the peak. Seek and FIR swap are sent to the worker over a pipe.
+    #
+    # Each block has the number of the FIR swap it is rendered with
+    # (ring_fir), and the gains of that config are applied. The worker
+    # renders the crossfade block relative to the gains of the new one.
+
+    def __init__(self, config, stream_ended, peak_updated, chunksize,
+                max_partition, dtype=np.float64, trim_db=None, lookahead=4,
+                threads=1, prefetch=0):
+        self.config = config
+        self.stream_ended = stream_ended # Qt Signal
+        self.peak_updated = peak_updated # Qt Signal
+        self.lookahead = lookahead
+
+        # start worker, and receive the stream info
+        # ('spawn': forking a process with Qt and PortAudio is unsafe)
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, conn = ctx.Pipe()
+        args = (chunksize, max_partition, dtype, trim_db, 0, threads,
+                                                                    prefetch)
+        self.process = ctx.Process(target=_render_process,
+                                    args=(conn, config, args), daemon=True)
+        self.process.start()
+        msg = self.conn.recv()
+        if msg[0] == 'error':
+            self.process.join()
+            raise Exception(msg[1])
+        (self.fs, self.nframes, self.nchannels_src, self.nchannels_out,
+                                            self.mode, self.fir_shape) = msg[1]
+
+        # shared ring buffer
+        size = _ring(None, lookahead, chunksize, self.nchannels_out)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        (self.n, self.ring_end, self.ring_gen, self.ring_pos,
+                                            self.ring_fir, self.ring) \
+            = _ring(self.shm.buf, lookahead, chunksize, self.nchannels_out)
+        self.n[:] = 0
+        self.conn.send(('start', self.shm.name, lookahead))
+
+        self.out = np.zeros([chunksize, self.nchannels_out], dtype=np.float32)
+        self.gen = 0
+        self.play_pos = 0
+        self.underrun = 0
+
+        # config of each FIR swap (not played yet, and the playing one)
+        self.configs = {0: config}
+        self.n_swap = 0
+        self.fir = 0
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(('close',))
+            self.process.join()
+        # release the views before the shared memory
+        del self.n, self.ring_end, self.ring_gen, self.ring_pos
+        del self.ring_fir, self.ring
+        self.shm.close()
+        self.shm.unlink()
+
+    def callback(self, in_data, frame_count, time_info, status):
+        # copy the oldest block in the ring buffer (n: [n_write, n_read])
+        # (drop only the blocks rendered before set_pos())
+        n_write, n_read = self.n
+        n_0 = n_read
+        while (n_read != n_write
+                and self.ring_gen[n_read % self.lookahead] != self.gen):
+            n_read += 1
+        self.n[1] = n_read
+        if n_read == n_write:
+            if n_read == n_0:
+                self.underrun += 1
+            self.out[:] = 0
+            return self.out, pyaudio.paContinue
+
+        i = n_read % self.lookahead
+
+        if self.ring_end[i]:
             self.stream_ended.emit() # emit signal
             return b'', pyaudio.paComplete
 
-        # gain (FIR)
-        data_out *= self.config['gain_fir']
+        # the gains of the FIR from its crossfade block
+        if self.ring_fir[i] != self.fir:
+            self.fir = int(self.ring_fir[i])
+            self.config = self.configs[self.fir]
+            for k in [k for k in self.configs if k < self.fir]:
+                del self.configs[k]
+
+        gain = self.config['gain_src'] * self.config['gain_fir']
+        np.multiply(self.ring[i], gain, out=self.out)
+        self.play_pos = self.ring_pos[i]
+        self.n[1] = n_read + 1
 
         # peak
-        self._detect_peak(data_out)
+        self._detect_peak(self.out)
         
         # output
-        return data_out.reshape(-1, order='F').tostring(), pyaudio.paContinue
+        return self.out, pyaudio.paContinue
+
+    _detect_peak = WavGenerator._detect_peak
+
+    def swap_fir(self, config):
+        # (see ConvGenerator.swap_fir(); raises the error of the worker)
+        # The worker scales the old FIR of the crossfade block by the
+        # gain relative to the new one (0 if the new gain is 0).
+        old = self.configs[self.n_swap]
+        gain_old = old['gain_src'] * old['gain_fir']
+        gain_new = config['gain_src'] * config['gain_fir']
+        ratio = gain_old / gain_new if gain_new != 0 else 0
+        self.conn.send(('swap', config, self.n_swap + 1, ratio))
+        msg = self.conn.recv()
+        if msg[0] == 'error':
+            raise Exception(msg[1])
+        self.mode, self.fir_shape = msg[1]
+        self.n_swap += 1
+        self.configs[self.n_swap] = config
 
     def set_pos(self, pos):
-        self.os.clear_buffer()
-        self.wf.setpos(pos)
+        self.gen += 1
+        self.play_pos = pos
+        self.conn.send(('seek', pos, self.gen))
+
+    def get_pos(self):
+        return self.play_pos
+
+
+
+class Prefetcher:
+    # source frames read and decoded ahead by a worker thread
+    #
+    # The worker (_read_ahead()) reads the blocks after the position from
+    # the file (wavfile.WavReader) and decodes them into a ring buffer,
+    # so that the PortAudio callback (or the render-ahead thread) only
+    # copies decoded frames from memory (read()), and never waits for
+    # the disk. The worker asks the OS to read the range ahead into the
+    # page cache in large sequential reads (WavReader.advise()).
+    #
+    # The ring is used in the same way as the render-ahead of
+    # ConvGenerator: each index is written by one thread only (n_write:
+    # worker, n_read: consumer), and seek() increments gen, so that the
+    # worker starts reading at the new position at once, and the blocks
+    # read before it are dropped by the consumer.
+    #
+    # frames: the number of frames read ahead (in blocks of frames/blocks)
+
+    # the range of advise() relative to frames
+    ADVISE = 4
+
+    def __init__(self, wf, decode, dtype, frames, blocks=8):
+        self.wf = wf
+        self.decode = decode
+        self.nchannels = wf.getnchannels()
+        self.blocks = blocks
+        self.blocksize = max(frames // blocks, 1)
+
+        n = self.blocksize * self.nchannels
+        self.ring = np.zeros([blocks, n], dtype=dtype)
+        self.ring_len = np.zeros(blocks, dtype=np.int64) # (0: the end)
+        self.ring_gen = np.zeros(blocks, dtype=np.int64)
+        self.scratch = np.zeros(n, dtype='<i4')
+        self.n_read = 0
+        self.n_write = 0
+        self.offset = 0 # frames of the block n_read already read
+
+        self.pos = 0 # of the consumer
+        self.gen = 0
+        self.read_gen = 0 # gen of the consumer
+        self.next_pos = 0
+        self.underrun = 0
+        self.wake = threading.Event() # (-> worker)
+        self.filled = threading.Event() # (-> consumer, see wait())
+        self.running = True
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
+
+    def seek(self, pos):
+        # (any thread)
+        if pos < 0 or pos > self.wf.getnframes():
+            raise Exception('position not in range')
+        self.next_pos = pos
+        self.pos = pos
+        self.gen += 1
+        self.wake.set()
+
+    def ready(self, n):
+        # True if the next n frames (or up to the end) are read ahead
+        self._drop()
+        available = -self.offset
+        for j in range(self.n_read, self.n_write):
+            i = j % self.blocks
+            if self.ring_gen[i] != self.read_gen:
+                return False
+            if self.ring_len[i] == 0:
+                return True
+            available += self.ring_len[i]
+            if available >= n:
+                return True
+        return False
+
+    def read(self, out, n):
+        # copy the next n frames into out (interleaved [n * channels]),
+        # and return the number of frames (fewer at the end of the
+        # source), or None if they are not read ahead yet (not consumed)
+        if not self.ready(n):
+            self.underrun += 1
+            return None
+
+        ch = self.nchannels
+        m = 0
+        while m < n:
+            i = self.n_read % self.blocks
+            len_block = int(self.ring_len[i])
+            if len_block == 0:
+                break
+            k = min(len_block - self.offset, n - m)
+            out[m * ch:(m + k) * ch] \
+                    = self.ring[i, self.offset * ch:(self.offset + k) * ch]
+            m += k
+            self.offset += k
+            if self.offset == len_block:
+                self.offset = 0
+                self.n_read += 1
+                self.wake.set()
+        self.pos += m
+        return m
+
+    def wait(self, timeout):
+        # wait until the worker reads a block (at most timeout seconds)
+        self.filled.clear()
+        self.filled.wait(timeout)
+
+    def _drop(self):
+        # drop the blocks read before seek() (consumer)
+        gen = self.gen
+        if self.read_gen != gen:
+            self.read_gen = gen
+            self.pos = self.next_pos
+            self.offset = 0
+        while (self.n_read != self.n_write
+                    and self.ring_gen[self.n_read % self.blocks] != gen):
+            self.n_read += 1
+            self.wake.set()
+
+    def _read_ahead(self):
+        # worker thread
+        gen = self.gen
+        pos = 0
+        advised = 0 # the end of the range given to advise()
+        span = self.blocks * self.blocksize
+        while self.running:
+            self.wake.clear()
+            if gen != self.gen:
+                gen = self.gen
+                pos = self.next_pos
+                advised = pos
+            if self.n_write - self.n_read >= self.blocks:
+                self.wake.wait()
+                continue
+
+            # (the next range when less than frames is left)
+            if advised - pos < span:
+                self.wf.advise(pos, self.ADVISE * span)
+                advised = pos + self.ADVISE * span
+
+            i = self.n_write % self.blocks
+            frames = self.wf.frames(pos, self.blocksize)
+            len_block = len(frames) // self.wf.block_align
+            self.decode(frames, self.ring[i], self.scratch)
+            self.ring_len[i] = len_block
+            self.ring_gen[i] = gen
+            pos += len_block
+            self.n_write += 1
+            self.filled.set()
+
+
+
+def _ring(buf, lookahead, chunksize, ch_out):
+    # views of the shared ring buffer in buf
+    # (buf None: return the size in bytes)
+    #
+    #   n:        [n_write, n_read] (written by worker / callback only)
+    #   ring_end: [lookahead] the stream has ended at the block
+    #   ring_gen: [lookahead] set_pos() count of the block
+    #   ring_pos: [lookahead] source position after the block
+    #   ring_fir: [lookahead] FIR swap count of the block
+    #   ring:     [lookahead, chunksize, ch_out] float32
+    n_int = 2 + 4 * lookahead
+    size = n_int * 8 + lookahead * chunksize * ch_out * 4
+    if buf is None:
+        return size
+    ints = np.ndarray([n_int], dtype=np.int64, buffer=buf)
+    ring = np.ndarray([lookahead, chunksize, ch_out], dtype=np.float32,
+                                            buffer=buf, offset=n_int * 8)
+    return (ints[:2], ints[2:2 + lookahead],
+                ints[2 + lookahead:2 + 2 * lookahead],
+                ints[2 + 2 * lookahead:2 + 3 * lookahead],
+                ints[2 + 3 * lookahead:], ring)
+
+
+class _NoSignal:
+    # stands for Qt signals in the worker process
+    def emit(self):
+        pass
+
+
+def _render_process(conn, config, args):
+    # worker process of ProcessGenerator
+    config = dict(config, gain_src=1, gain_fir=1)
+    try:
+        gene = ConvGenerator(config, _NoSignal(), _NoSignal(), *args)
+    except Exception as e:
+        conn.send(('error', str(e)))
+        return
+    conn.send(('info', (gene.fs, gene.nframes, gene.nchannels_src,
+                    gene.nchannels_out, gene.mode, gene.fir_shape)))
+
+    _, name, lookahead = conn.recv()
+    shm = shared_memory.SharedMemory(name)
+    n, ring_end, ring_gen, ring_pos, ring_fir, ring = _ring(shm.buf,
+                            lookahead, gene.chunksize, gene.nchannels_out)
+
+    # poll the pipe for a quarter of the block period when the ring is full
+    # (or the source is not read ahead yet)
+    period = gene.chunksize / gene.fs / 4
+    gen = 0
+    fir = 0
+    while True:
+        full = n[0] - n[1] >= lookahead or not gene.ready()
+        if conn.poll(period if full else 0):
+            msg = conn.recv()
+            if msg[0] == 'close':
+                break
+            elif msg[0] == 'seek':
+                gene._seek(msg[1])
+                gen = msg[2]
+            elif msg[0] == 'swap':
+                # (the next block is the crossfade, of the new FIR)
+                try:
+                    gene.swap_fir(dict(msg[1], gain_src=1, gain_fir=1))
+                    gene.config = dict(gene.config, gain_fir=msg[3])
+                    fir = msg[2]
+                    conn.send(('ok', (gene.mode, gene.fir_shape)))
+                except Exception as e:
+                    conn.send(('error', str(e)))
+            continue
+        if full:
+            continue
+
+        i = n[0] % lookahead
+        ring_end[i] = gene._render(ring[i])
+        ring_gen[i] = gen
+        ring_pos[i] = gene.pos
+        ring_fir[i] = fir
+        n[0] += 1
 
+    gene.close()
+    del n, ring_end, ring_gen, ring_pos, ring_fir, ring
+    shm.close()
 
     
 
@@ -297,7 +297,7 @@ class PlayListModel(QtCore.QAbstractTableModel):
             _, ext = os.path.splitext(url)
             if ext == '.csv':
                 urls_csv.append(url)
-            elif ext == '.wav':
+            elif ext in ('.wav', '.w64'):
                 urls_wav.append(url)
             elif ext == '.npy':
                 urls_npy.append(url)
@@ -0,0 +1,85 @@
+# The playback callback makes no new arrays in the steady state
+# (see ConvGenerator). Only pyFFTW reuses the output of the transforms;
+# scipy.fft and NumPy return a new array on every call.
+#
+#   python -m pytest tests
+
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyaudio')
+pytest.importorskip('PyQt5')
+pytest.importorskip('pyfftw')
+
+import fftbackend
+import fircache
+import wavfile
+import player
+
+
+CHUNK = 1024
+CALLBACKS = 8
+
+# bytes allowed for the Python objects of a callback (ints, views),
+# much less than any array of a block (CHUNK * 2 channels * 4 bytes)
+SLACK = 4096
+
+
+class _Signal:
+    def emit(self):
+        pass
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.setattr(fftbackend, 'BACKEND', 'pyfftw')
+    monkeypatch.setattr(fircache, 'cache',
+                                fircache.SpectrumCache(str(tmp_path / 'cache')))
+
+    rng = np.random.default_rng(0)
+    path2src = str(tmp_path / 'src.wav')
+    x = rng.integers(-2 ** 15, 2 ** 15, (48000, 2)).astype('<i2')
+    with wavfile.WavWriter(path2src, 2, 2, 48000, x.shape[0]) as ww:
+        ww.writeframes(x)
+
+    path2fir = str(tmp_path / 'fir.npy')
+    np.save(path2fir, rng.standard_normal((2, 2, 5000)) * 0.01)
+
+    return {'path2src': path2src, 'path2fir': path2fir,
+            'gain_src': 1, 'gain_fir': 1, 'peak': 0}
+
+
+@pytest.mark.parametrize('lookahead, prefetch', [(0, 0), (4, 65536)])
+def test_callback_alloc(config, lookahead, prefetch):
+    gene = player.ConvGenerator(config, _Signal(), _Signal(), CHUNK,
+                        4 * CHUNK, np.float32, None, lookahead, 1, prefetch)
+
+    def callback():
+        # (wait for the threads, the callback does not)
+        while not (gene.n_write - gene.n_read == lookahead
+                        if lookahead > 0 else gene.ready()):
+            time.sleep(0.001)
+        out, flag = gene.callback(None, CHUNK, None, None)
+        assert flag == player.pyaudio.paContinue
+
+    try:
+        # plans, views of the file, ...
+        for i in range(CALLBACKS):
+            callback()
+
+        tracemalloc.start()
+        try:
+            base, _ = tracemalloc.get_traced_memory()
+            for i in range(CALLBACKS):
+                callback()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        gene.close()
+
+    assert current - base < SLACK
+    assert peak - base < SLACK
@@ -0,0 +1,101 @@
+# After the crossfade block of swap_fir(), the output is the convolution
+# of the whole source with the new FIR, also with a longer FIR than the
+# old one (the input history is read again from the source).
+#
+#   python -m pytest tests
+
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyaudio')
+pytest.importorskip('PyQt5')
+
+import fircache
+import wavfile
+import player
+
+
+CHUNK = 1024
+SWAP = 20 # the block of swap_fir()
+
+
+class _Signal:
+    def emit(self):
+        pass
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    # source, FIRs and the direct convolution of the source with them
+    path = tmp_path_factory.mktemp('swap')
+    rng = np.random.default_rng(0)
+    path2src = str(path / 'src.wav')
+    x = rng.integers(-2 ** 12, 2 ** 12, (40 * CHUNK, 2)).astype('<i2')
+    with wavfile.WavWriter(path2src, 2, 2, 48000, x.shape[0]) as ww:
+        ww.writeframes(x)
+
+    path2fir = {}
+    refs = {}
+    for name, len_fir in [('short', 3000), ('long', 20000)]:
+        fir = rng.standard_normal(len_fir) / np.sqrt(len_fir)
+        path2fir[name] = str(path / (name + '.npy'))
+        np.save(path2fir[name], fir)
+        refs[name] = np.array([np.convolve(x_ch / 2 ** 15, fir)
+                                                        for x_ch in x.T])
+    return path2src, path2fir, refs
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(fircache, 'cache',
+                                fircache.SpectrumCache(str(tmp_path)))
+
+
+def _render(gene, lookahead):
+    # output blocks [ch, CHUNK] until the end, swap_fir() at SWAP
+    blocks = []
+    while True:
+        while lookahead > 0 and gene.n_write == gene.n_read:
+            time.sleep(0.001)
+        if len(blocks) == SWAP:
+            gene.swap_fir(gene.swap_config)
+        out, flag = gene.callback(None, CHUNK, None, None)
+        if flag != player.pyaudio.paContinue:
+            return blocks
+        blocks.append(np.array(out, dtype=np.float64).T)
+
+
+@pytest.mark.parametrize('lookahead', [0, 4])
+@pytest.mark.parametrize('max_partition', [CHUNK, 8 * CHUNK])
+@pytest.mark.parametrize('old, new', [('short', 'long'), ('long', 'short')])
+def test_swap_fir(files, lookahead, max_partition, old, new):
+    path2src, path2fir, refs = files
+    config = {'path2src': path2src, 'path2fir': path2fir[old],
+                                    'gain_src': 1, 'gain_fir': 1, 'peak': 0}
+    gene = player.ConvGenerator(config, _Signal(), _Signal(), CHUNK,
+                            max_partition, np.float64, None, lookahead)
+    gene.swap_config = dict(config, path2fir=path2fir[new])
+    try:
+        blocks = _render(gene, lookahead)
+    finally:
+        gene.close()
+
+    # each block is of the old FIR, the crossfade, or of the new FIR
+    kinds = ''
+    for k, block in enumerate(blocks):
+        def matches(ref):
+            y = np.zeros([2, CHUNK])
+            y_k = ref[:, k * CHUNK:(k + 1) * CHUNK]
+            y[:, :y_k.shape[1]] = y_k
+            return np.allclose(block, y, rtol=0, atol=1e-6)
+        if matches(refs[old]):
+            kinds += 'o'
+        elif matches(refs[new]):
+            kinds += 'n'
+        else:
+            kinds += 'x'
+    fade = kinds.index('x')
+    assert fade >= SWAP
+    assert kinds == 'o' * fade + 'x' + 'n' * (len(kinds) - fade - 1)
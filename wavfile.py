@@ -0,0 +1,359 @@
+import os
+import queue
+import struct
+import threading
+import numpy as np
+
+
+# format tags of the fmt chunk
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# the largest size of RIFF (bytes, larger files are written as RF64)
+RIFF_MAX = 0xFFFFFFFF
+
+# GUIDs of Sony Wave64 (W64) chunks
+_W64_GUID = b'\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+_W64_RIFF = b'riff\x2e\x91\xcf\x11\xa5\xd6\x28\xdb\x04\xc1\x00\x00'
+_W64_WAVE = b'wave' + _W64_GUID
+_W64_FMT = b'fmt ' + _W64_GUID
+_W64_DATA = b'data' + _W64_GUID
+
+# WavWriter: size of a write (bytes) and the number of buffers
+# (one filled by the caller, the others waiting or being written)
+WRITE_BUFFER = 4 * 1024 ** 2
+WRITE_BUFFERS = 3
+
+
+
+class WavReader:
+    # PCM or IEEE float WAV file read through a memory map
+    # (WAV, RF64/BW64 and W64 of more than 4 GB)
+    #
+    # The header is parsed once, and the data chunk is mapped as
+    # bytes (np.memmap). readframes() returns a view of the mapped
+    # file, so no bytes are copied before the conversion to float
+    # (np.frombuffer() of the view is also a view), and setpos() only
+    # sets the position.
+    #
+    # It has the interface of wave.Wave_read used by the generators,
+    # and can be used in place of wave.open(path, 'rb').
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            # chunks up to the data chunk (fmt chunk before it)
+            head = _read(f, 12)
+            if head[:4] == b'riff':
+                fmt, size = _w64_chunks(f, head)
+            else:
+                fmt, size = _riff_chunks(f, head)
+            if fmt is None:
+                raise Exception('fmt chunk not found')
+            self.offset = f.tell()
+            size = min(size, os.fstat(f.fileno()).st_size - self.offset)
+
+        tag, self.nchannels, self.fs, _, self.block_align, bits \
+                                        = struct.unpack('<HHIIHH', fmt[:16])
+        if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            tag = struct.unpack('<H', fmt[24:26])[0] # (sub format)
+        if (tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT)
+                or self.nchannels == 0):
+            raise Exception('Unsupported wave format')
+        self.is_float = tag == WAVE_FORMAT_IEEE_FLOAT # (see pcm.decoder())
+        self.sampwidth = (bits + 7) // 8
+        self.nframes = size // self.block_align
+
+        # data chunk [nframes * block_align] (uint8)
+        n_bytes = self.nframes * self.block_align
+        if n_bytes > 0:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r',
+                                        offset=self.offset, shape=(n_bytes,))
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+        self.pos = 0
+        self.path = path
+        self.fd = None # (see advise())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # (the map is released with the last view of it)
+        self.data = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def getnchannels(self):
+        return self.nchannels
+
+    def getsampwidth(self):
+        return self.sampwidth
+
+    def getframerate(self):
+        return self.fs
+
+    def getnframes(self):
+        return self.nframes
+
+    def frames(self, pos, n):
+        # view of n frames from pos (bytes, fewer at the end)
+        pos = min(max(pos, 0), self.nframes)
+        n = min(max(n, 0), self.nframes - pos)
+        return self.data[pos * self.block_align:(pos + n) * self.block_align]
+
+    def readframes(self, n):
+        # view of the next n frames (see frames())
+        frames = self.frames(self.pos, n)
+        self.pos += len(frames) // self.block_align
+        return frames
+
+    def advise(self, pos, n):
+        # ask the OS to read n frames from pos into the page cache in the
+        # background (posix_fadvise(), where available), so that the
+        # views of them are read from memory
+        # The whole file is also marked as read sequentially (larger
+        # read-ahead of the kernel).
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        pos = min(max(pos, 0), self.nframes)
+        n = min(max(n, 0), self.nframes - pos)
+        if n > 0:
+            os.posix_fadvise(self.fd, self.offset + pos * self.block_align,
+                                n * self.block_align, os.POSIX_FADV_WILLNEED)
+
+    def setpos(self, pos):
+        if pos < 0 or pos > self.nframes:
+            raise Exception('position not in range')
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+
+class WavWriter:
+    # PCM WAV file written in large blocks by a background thread
+    # (container, is_float: see create())
+    #
+    # The header is written once for nframes (the expected length), and
+    # the file is extended to the full size. writeframes() copies the
+    # frames into a buffer of WRITE_BUFFER bytes, and a full buffer is
+    # written by the write-behind thread, so that the caller (e.g. the
+    # convolution of the next block) continues while the disk is busy.
+    # It waits only when all WRITE_BUFFERS buffers are in use.
+    # close() writes the rest, and patches the header (and the file
+    # size) only if the number of frames differs from nframes.
+    # An error in the thread is raised by writeframes() or close().
+    #
+    # It can be used in place of wave.open(path, 'wb') with setparams().
+
+    def __init__(self, path, nchannels, sampwidth, fs, nframes=0,
+                                        container='wav', is_float=False):
+        self.nchannels = nchannels
+        self.sampwidth = sampwidth
+        self.fs = fs
+        self.nframes = nframes
+        self.is_float = is_float
+        self.block_align = nchannels * sampwidth
+        self.n_bytes = 0 # written by the caller
+
+        # (the header of RF64 is kept when fewer frames are written)
+        self.container = _container(container, nframes * self.block_align,
+                                                                    is_float)
+        self.f = open(path, 'wb')
+        self.offset = create(self.f, nchannels, sampwidth, fs, nframes,
+                                                self.container, is_float)
+
+        # buffers (free: to be filled, full: to be written)
+        self.free = queue.Queue()
+        for i in range(WRITE_BUFFERS - 1):
+            self.free.put(bytearray(WRITE_BUFFER))
+        self.full = queue.Queue()
+        self.buf = memoryview(bytearray(WRITE_BUFFER))
+        self.n = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._write_behind,
+                                                                daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def writeframes(self, data):
+        # data: bytes-like (copied, can be reused by the caller)
+        self._check()
+        data = memoryview(data).cast('B')
+        self.n_bytes += len(data)
+        while len(data) > 0:
+            k = min(len(data), WRITE_BUFFER - self.n)
+            self.buf[self.n:self.n + k] = data[:k]
+            self.n += k
+            data = data[k:]
+            if self.n == WRITE_BUFFER:
+                self._flush()
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            if self.error is None:
+                self._flush()
+            self.full.put(None)
+            self.thread.join()
+            self._check()
+
+            nframes = self.n_bytes // self.block_align
+            if nframes != self.nframes:
+                if (_container(self.container, self.n_bytes, self.is_float)
+                                                        != self.container):
+                    raise Exception('WAV file exceeds 4 GB')
+                self.f.seek(0)
+                create(self.f, self.nchannels, self.sampwidth, self.fs,
+                                    nframes, self.container, self.is_float)
+        finally:
+            self.f.close()
+            self.f = None
+
+    def _flush(self):
+        # pass the filled buffer to the thread, and take a free one
+        self.full.put((self.buf.obj, self.n))
+        self.buf = memoryview(self.free.get())
+        self.n = 0
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _write_behind(self):
+        # thread
+        self.f.seek(self.offset)
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            buf, n = item
+            if self.error is None:
+                try:
+                    self.f.write(memoryview(buf)[:n])
+                except Exception as e:
+                    self.error = e
+            self.free.put(buf)
+
+
+
+def create(f, nchannels, sampwidth, fs, nframes, container='wav',
+                                                            is_float=False):
+    # write the header of PCM WAV of nframes into f (at the current
+    # position), set the file size, and return the offset of the data
+    #
+    # container: 'wav' (RF64 if larger than RIFF_MAX), 'rf64' or 'w64'
+    # RF64 has the 64-bit sizes in the ds64 chunk (EBU Tech 3306),
+    # W64 has 64-bit chunk sizes and GUIDs as chunk IDs.
+    # is_float: IEEE float (WAVEFORMATEX with cbSize 0, and the fact
+    # chunk of RIFF/RF64) instead of PCM
+    # (no pad byte after the data of odd size, the same as wave)
+    size = nframes * nchannels * sampwidth
+    tag = WAVE_FORMAT_IEEE_FLOAT if is_float else WAVE_FORMAT_PCM
+    fmt = struct.pack('<HHIIHH', tag, nchannels, fs,
+            fs * nchannels * sampwidth, nchannels * sampwidth, 8 * sampwidth)
+    chunks = b''
+    if is_float:
+        fmt += struct.pack('<H', 0)
+        chunks = struct.pack('<4sII', b'fact', 4, min(nframes, 0xFFFFFFFF))
+    container = _container(container, size, is_float)
+    if container == 'w64':
+        pad = bytes(-len(fmt) % 8)
+        header = struct.pack('<16sQ16s16sQ', _W64_RIFF,
+                                88 + len(fmt) + len(pad) + size,
+                                _W64_WAVE, _W64_FMT, 24 + len(fmt))
+        header += fmt + pad + struct.pack('<16sQ', _W64_DATA, 24 + size)
+    else:
+        chunks = struct.pack('<4sI', b'fmt ', len(fmt)) + fmt + chunks
+        if container == 'rf64':
+            header = struct.pack('<4sI4s4sIQQQI', b'RF64', 0xFFFFFFFF,
+                            b'WAVE', b'ds64', 28, 48 + len(chunks) + size,
+                            size, nframes, 0)
+            header += chunks + struct.pack('<4sI', b'data', 0xFFFFFFFF)
+        else:
+            header = struct.pack('<4sI4s', b'RIFF', 12 + len(chunks) + size,
+                                                                    b'WAVE')
+            header += chunks + struct.pack('<4sI', b'data', size)
+    f.write(header)
+    f.truncate(len(header) + size)
+    return len(header)
+
+
+def _container(container, size, is_float=False):
+    # container of the data of size (bytes)
+    # (the RIFF size is size + 36, or + 50 with the fact chunk)
+    if container == 'wav' and size + (50 if is_float else 36) > RIFF_MAX:
+        return 'rf64'
+    elif container in ('wav', 'rf64', 'w64'):
+        return container
+    raise Exception('unknown container: %s' % container)
+
+
+
+def _riff_chunks(f, head):
+    # fmt chunk and the size of the data chunk of RIFF or RF64/BW64
+    # (head: the first 12 bytes, f at the first chunk -> at the data)
+    riff, _, wave_id = struct.unpack('<4sI4s', head)
+    if riff not in (b'RIFF', b'RF64', b'BW64') or wave_id != b'WAVE':
+        raise Exception('not a WAV file')
+    fmt = None
+    data_size = None # (ds64)
+    while True:
+        chunk_id, size = struct.unpack('<4sI', _read(f, 8))
+        if chunk_id == b'ds64':
+            ds64 = _read(f, size)
+            if size >= 16:
+                data_size = struct.unpack('<Q', ds64[8:16])[0]
+            f.seek(size % 2, 1)
+        elif chunk_id == b'fmt ':
+            fmt = _read(f, size)
+            f.seek(size % 2, 1)
+        elif chunk_id == b'data':
+            if size == 0xFFFFFFFF and data_size is not None:
+                size = data_size
+            return fmt, size
+        else:
+            f.seek(size + size % 2, 1)
+
+
+def _w64_chunks(f, head):
+    # fmt chunk and the size of the data chunk of W64 (see _riff_chunks())
+    # (the sizes include the chunk headers, chunks are aligned to 8 bytes)
+    head += _read(f, 28)
+    if head[:16] != _W64_RIFF or head[24:40] != _W64_WAVE:
+        raise Exception('not a WAV file')
+    fmt = None
+    while True:
+        guid, size = struct.unpack('<16sQ', _read(f, 24))
+        if size < 24:
+            raise Exception('not a WAV file')
+        if guid == _W64_FMT:
+            fmt = _read(f, size - 24)
+            f.seek(-size % 8, 1)
+        elif guid == _W64_DATA:
+            return fmt, size - 24
+        else:
+            f.seek(size - 24 + -size % 8, 1)
+
+
+
+def _read(f, n):
+    # n bytes from f (error at the end of the file)
+    b = f.read(n)
+    if len(b) < n:
+        raise Exception('data chunk not found')
+    return b